@@ -0,0 +1,953 @@
+# Offline benchmarks for bot.py. Telegram and Mongo are replaced by fakes:
+# FakeClient answers every request after a configurable delay (optionally
+# raising FloodWaitError) and counts requests per method, FakeDatabase keeps
+# collections in memory. Updates are fed straight into the bot's registered
+# handlers, so the numbers cover the real command, enforcement and broadcast
+# code paths.
+#
+#   python bench.py                      # every scenario with default sizes
+#   python bench.py firehose --updates 50000 --seed-index
+#   python bench.py broadcast --broadcast-groups 50000 --real-budgets
+#
+# Results are printed as a table (or JSON with --json): throughput, p50/p99
+# latency per update and Telegram requests per update.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib
+import itertools
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+
+from telethon import events, utils
+from telethon.errors import FloodWaitError, UserNotParticipantError
+from telethon.tl.types import (
+    User, Channel, ChatPhotoEmpty, PeerChannel, ChatAdminRights,
+    ChannelParticipant, ChannelParticipantAdmin, ChannelParticipantsAdmins
+)
+from pymongo.errors import OperationFailure
+
+BOT_ID = 7000000001
+OWNER_ID = 100
+CHANNEL_BASE = 1000000000
+UNLIMITED = 1e9
+
+# In-memory Mongo. Enough of motor's collection API for bot.py: filters with
+# equality and comparison operators, projections, sort/limit cursors, the
+# update operators the bot writes and bulk_write. Equality lookups go through
+# lazily built per-field indexes and range scans through sorted field lists.
+def _get(doc, field):
+    for part in field.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+def _has(doc, field):
+    for part in field.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return False
+        doc = doc[part]
+    return True
+
+def _set(doc, field, value):
+    *parents, last = field.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def _unset(doc, field):
+    *parents, last = field.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+def _compare(value, op, operand):
+    if op == "$eq":
+        return value == operand
+    if op == "$ne":
+        return value != operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if op == "$exists":
+        return (value is not None) == bool(operand)
+    if value is None:
+        return False
+    if op == "$gt":
+        return value > operand
+    if op == "$gte":
+        return value >= operand
+    if op == "$lt":
+        return value < operand
+    if op == "$lte":
+        return value <= operand
+    raise OperationFailure(f"Unsupported query operator {op}")
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict) and condition and next(iter(condition)).startswith("$"):
+            value = _get(doc, field)
+            for op, operand in condition.items():
+                if op == "$exists":
+                    if _has(doc, field) != bool(operand):
+                        return False
+                elif not _compare(value, op, operand):
+                    return False
+        elif _get(doc, field) != condition:
+            return False
+    return True
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        out = {k: doc[k] for k in include if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+def _hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+def _sort_key(value):
+    return (value is not None, value)
+
+class FakeCursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key, direction=None):
+        self._sort = [(key, direction or 1)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _docs(self):
+        wanted = self._skip + self._limit if self._limit else None
+        if self._sort and len(self._sort) == 1:
+            field, direction = self._sort[0]
+            docs = self.collection._range(field, direction, self.query.get(field))
+        else:
+            docs = self.collection._candidates(self.query)
+            if self._sort:
+                for field, direction in reversed(self._sort):
+                    docs = sorted(docs, key=lambda d: _sort_key(_get(d, field)), reverse=direction == -1)
+        out = []
+        for doc in docs:
+            if matches(doc, self.query):
+                out.append(doc)
+                if wanted and len(out) >= wanted:
+                    break
+        return [project(doc, self.projection) for doc in out[self._skip:]]
+
+    # Like motor, to_list and iteration consume the cursor, so repeated
+    # to_list(n) calls walk through the results n at a time
+    def _iter(self):
+        if self._results is None:
+            self._results = iter(self._docs())
+        return self._results
+
+    async def to_list(self, length=None):
+        return list(itertools.islice(self._iter(), length))
+
+    def __aiter__(self):
+        self._iter()
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FakeCollection:
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.ops = defaultdict(int)
+        self._indexes = {}
+        self._sorted = {}
+        self._ids = itertools.count(1)
+
+    def _index(self, field):
+        index = self._indexes.get(field)
+        if index is None:
+            index = self._indexes[field] = defaultdict(set)
+            for _id, doc in self.docs.items():
+                value = _get(doc, field)
+                if _hashable(value):
+                    index[value].add(_id)
+        return index
+
+    def _track(self, doc, add):
+        for field, index in self._indexes.items():
+            value = _get(doc, field)
+            if not _hashable(value):
+                continue
+            if add:
+                index[value].add(doc["_id"])
+            else:
+                ids = index.get(value)
+                if ids is not None:
+                    ids.discard(doc["_id"])
+                    if not ids:
+                        del index[value]
+        self._sorted.clear()
+
+    def _candidates(self, query):
+        for field, condition in query.items():
+            if field.startswith("$") or isinstance(condition, dict) or not _hashable(condition):
+                continue
+            return [self.docs[_id] for _id in self._index(field).get(condition, ())]
+        return list(self.docs.values())
+
+    # Documents ordered by one field, starting at the lower bound of a range
+    # condition on that field when there is one
+    def _range(self, field, direction, condition):
+        entry = self._sorted.get(field)
+        if entry is None:
+            docs = sorted(self.docs.values(), key=lambda d: _sort_key(_get(d, field)))
+            entry = self._sorted[field] = ([_sort_key(_get(d, field)) for d in docs], docs)
+        keys, docs = entry
+        if direction == -1:
+            return reversed(docs)
+        if isinstance(condition, dict):
+            if "$gt" in condition:
+                return itertools.islice(docs, bisect_right(keys, _sort_key(condition["$gt"])), None)
+            if "$gte" in condition:
+                return itertools.islice(docs, bisect_left(keys, _sort_key(condition["$gte"])), None)
+        return iter(docs)
+
+    def _insert(self, doc):
+        doc.setdefault("_id", next(self._ids))
+        if doc["_id"] in self.docs:
+            raise OperationFailure(f"E11000 duplicate key {doc['_id']!r} in {self.name}")
+        self.docs[doc["_id"]] = doc
+        self._track(doc, True)
+        return doc["_id"]
+
+    def _first(self, query):
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                return doc
+        return None
+
+    def _apply(self, doc, update, inserting=False):
+        self._track(doc, False)
+        self._modify(doc, update, inserting)
+        self._track(doc, True)
+
+    @staticmethod
+    def _modify(doc, update, inserting):
+        for op, fields in update.items():
+            for field, value in fields.items():
+                if op == "$set" or (op == "$setOnInsert" and inserting):
+                    _set(doc, field, value)
+                elif op == "$inc":
+                    _set(doc, field, (_get(doc, field) or 0) + value)
+                elif op == "$unset":
+                    _unset(doc, field)
+                elif op == "$max":
+                    current = _get(doc, field)
+                    _set(doc, field, value if current is None else max(current, value))
+                elif op == "$min":
+                    current = _get(doc, field)
+                    _set(doc, field, value if current is None else min(current, value))
+                elif op == "$addToSet":
+                    items = _get(doc, field) or []
+                    for item in value["$each"] if isinstance(value, dict) else [value]:
+                        if item not in items:
+                            items.append(item)
+                    _set(doc, field, items)
+                elif op == "$push":
+                    items = _get(doc, field) or []
+                    items.extend(value["$each"] if isinstance(value, dict) else [value])
+                    _set(doc, field, items)
+                elif op != "$setOnInsert":
+                    raise OperationFailure(f"Unsupported update operator {op}")
+
+    def _update(self, query, update, upsert, many=False):
+        docs = [doc for doc in self._candidates(query) if matches(doc, query)]
+        if not many:
+            docs = docs[:1]
+        for doc in docs:
+            self._apply(doc, update)
+        if docs or not upsert:
+            return SimpleNamespace(matched_count=len(docs), modified_count=len(docs), upserted_id=None)
+        doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        self._modify(doc, update, True)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=self._insert(doc))
+
+    def _delete(self, query, many):
+        docs = [doc for doc in self._candidates(query) if matches(doc, query)]
+        if not many:
+            docs = docs[:1]
+        for doc in docs:
+            self._track(doc, False)
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(docs))
+
+    async def find_one(self, query=None, projection=None):
+        self.ops["find_one"] += 1
+        doc = self._first(query or {})
+        return project(doc, projection) if doc is not None else None
+
+    def find(self, query=None, projection=None):
+        self.ops["find"] += 1
+        return FakeCursor(self, query, projection)
+
+    async def count_documents(self, query):
+        self.ops["count_documents"] += 1
+        return sum(1 for doc in self._candidates(query) if matches(doc, query))
+
+    async def estimated_document_count(self):
+        return len(self.docs)
+
+    async def insert_one(self, doc):
+        self.ops["insert_one"] += 1
+        return SimpleNamespace(inserted_id=self._insert(doc))
+
+    async def insert_many(self, docs, ordered=True):
+        self.ops["insert_many"] += 1
+        return SimpleNamespace(inserted_ids=[self._insert(doc) for doc in docs])
+
+    async def update_one(self, query, update, upsert=False):
+        self.ops["update_one"] += 1
+        return self._update(query, update, upsert)
+
+    async def update_many(self, query, update, upsert=False):
+        self.ops["update_many"] += 1
+        return self._update(query, update, upsert, many=True)
+
+    async def delete_one(self, query):
+        self.ops["delete_one"] += 1
+        return self._delete(query, False)
+
+    async def delete_many(self, query):
+        self.ops["delete_many"] += 1
+        return self._delete(query, True)
+
+    async def bulk_write(self, requests, ordered=True):
+        self.ops["bulk_write"] += 1
+        result = SimpleNamespace(inserted_count=0, matched_count=0, modified_count=0,
+                                 deleted_count=0, upserted_count=0)
+        for request in requests:
+            kind = type(request).__name__
+            if kind == "InsertOne":
+                self._insert(request._doc)
+                result.inserted_count += 1
+            elif kind in ("UpdateOne", "UpdateMany"):
+                outcome = self._update(request._filter, request._doc, request._upsert, kind == "UpdateMany")
+                result.matched_count += outcome.matched_count
+                result.modified_count += outcome.modified_count
+                result.upserted_count += outcome.upserted_id is not None
+            elif kind in ("DeleteOne", "DeleteMany"):
+                result.deleted_count += self._delete(request._filter, kind == "DeleteMany").deleted_count
+            else:
+                raise OperationFailure(f"Unsupported bulk operation {kind}")
+        return result
+
+    async def create_index(self, keys, **options):
+        return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+    def aggregate(self, pipeline):
+        docs = list(self.docs.values())
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif name == "$sort":
+                for field, direction in reversed(list(spec.items())):
+                    docs = sorted(docs, key=lambda d: _sort_key(_get(d, field)), reverse=direction == -1)
+            elif name == "$limit":
+                docs = docs[:spec]
+            elif name == "$project":
+                docs = [project(doc, spec) for doc in docs]
+            else:
+                raise OperationFailure(f"{name} is not supported by the in-memory database")
+        cursor = FakeCursor(self, {}, None)
+        cursor._docs = lambda: [dict(doc) for doc in docs]
+        return cursor
+
+    # Behaves like a standalone server, so stores fall back to polling
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = FakeCollection(name)
+        return collection
+
+    async def command(self, name, *args):
+        if name == "collStats":
+            return {"count": len(self[args[0]].docs), "size": 0, "totalIndexSize": 0}
+        if name == "ping":
+            return {"ok": 1}
+        raise OperationFailure(f"Command {name} is not supported by the in-memory database")
+
+    def ops(self):
+        return {f"{name}.{op}": n for name, c in self.collections.items() for op, n in c.ops.items()}
+
+# Stand-ins for the requests high-level client methods would send; the
+# gateway only looks at the class name
+_request_types = {}
+
+def rpc(method, **fields):
+    cls = _request_types.get(method)
+    if cls is None:
+        cls = _request_types[method] = type(method, (SimpleNamespace,), {})
+    return cls(**fields)
+
+def channel_id(n):
+    return utils.get_peer_id(PeerChannel(CHANNEL_BASE + n))
+
+def channel_entity(marked_id):
+    n = abs(marked_id) % 10 ** 9
+    return Channel(
+        id=CHANNEL_BASE + n, title=f"Bench Channel {n}", photo=ChatPhotoEmpty(),
+        date=None, broadcast=True, username=f"benchchan{n}", access_hash=n
+    )
+
+def user_entity(user_id):
+    return User(id=user_id, first_name=f"User{user_id}", username=f"user{user_id}", access_hash=user_id)
+
+class FakeMessage(SimpleNamespace):
+    pass
+
+class FakeParticipants:
+    def __init__(self, client, chat, filter):
+        self.client = client
+        self.chat = chat
+        self.filter = filter
+        self.total = None
+
+    async def __aiter__(self):
+        if self.filter is ChannelParticipantsAdmins or isinstance(self.filter, ChannelParticipantsAdmins):
+            ids = [BOT_ID, self.client.group_admin(self.chat)]
+        else:
+            ids = self.client.channel_members(self.chat)
+        self.total = len(ids)
+        for start in range(0, len(ids), 200):
+            await self.client(rpc("GetParticipantsRequest", channel=self.chat, offset=start))
+            for user_id in ids[start:start + 200]:
+                yield user_entity(user_id)
+
+# Fake Telegram. Every request goes through the bot's RPC gateway, waits
+# `latency` seconds and may fail with FloodWaitError. Membership is derived
+# from (user, channel) so it is stable across runs with the same seed.
+class FakeClient:
+    def __init__(self, botmod, latency=0.02, flood_rate=0.0, flood_seconds=1, join_rate=0.8,
+                 users=10000, seed=1):
+        self.botmod = botmod
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.join_rate = join_rate
+        self.population = range(1, users + 1)
+        self.random = random.Random(seed)
+        self.calls = defaultdict(int)
+        self.sent = []
+        self.revoked_links = set()
+        self._message_ids = itertools.count(1)
+
+    def is_member(self, user_id, channel):
+        return (user_id * 2654435761 + abs(channel)) % 1000 < self.join_rate * 1000
+
+    def channel_members(self, channel):
+        channel = self.botmod.marked_channel_id(channel)
+        return [user_id for user_id in self.population if self.is_member(user_id, channel)]
+
+    def group_admin(self, chat_id):
+        return abs(chat_id) % 10 ** 9 + 1
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        return await self.botmod.rpc_gateway.call(lambda: self._send(request), request)
+
+    async def _send(self, request):
+        method = type(request).__name__
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            raise FloodWaitError(request, capture=self.flood_seconds)
+        if method == "GetParticipantRequest":
+            channel = self.botmod.marked_channel_id(request.channel)
+            user_id = request.participant
+            if user_id == BOT_ID:
+                return SimpleNamespace(participant=ChannelParticipantAdmin(
+                    user_id=BOT_ID, promoted_by=OWNER_ID, date=datetime.now(), admin_rights=ChatAdminRights()
+                ))
+            if not self.is_member(user_id, channel):
+                raise UserNotParticipantError(request)
+            return SimpleNamespace(participant=ChannelParticipant(user_id=user_id, date=datetime.now()))
+        if method == "GetFullChannelRequest":
+            channel = self.botmod.marked_channel_id(request.channel)
+            return SimpleNamespace(
+                chats=[channel_entity(channel)],
+                full_chat=SimpleNamespace(participants_count=len(self.channel_members(channel)))
+            )
+        if method == "GetExportedChatInviteRequest":
+            return SimpleNamespace(invite=SimpleNamespace(link=request.link, revoked=request.link in self.revoked_links))
+        if method == "ExportChatInviteRequest":
+            return SimpleNamespace(link=f"https://t.me/+bench{abs(request.peer)}x{next(self._message_ids)}")
+        return getattr(request, "result", None)
+
+    async def get_me(self, input_peer=False):
+        me = User(id=BOT_ID, first_name="Bench Bot", username="benchbot", bot=True, access_hash=1)
+        return await self(rpc("GetUsersRequest", result=me))
+
+    async def get_entity(self, entity):
+        if isinstance(entity, str):
+            name = entity.lstrip("@").lower()
+            tail = name[len("benchchan"):]
+            n = int(tail) if name.startswith("benchchan") and tail.isdigit() else zlib.crc32(name.encode()) % 1000 + 1
+            return await self(rpc("ResolveUsernameRequest", result=channel_entity(n)))
+        if entity <= -10 ** 12 or 0 < entity - CHANNEL_BASE < 10 ** 9:
+            return await self(rpc("GetChannelsRequest", result=channel_entity(entity)))
+        return await self(rpc("GetUsersRequest", result=user_entity(entity)))
+
+    async def send_message(self, entity, message="", reply_to=None, buttons=None, file=None, **kwargs):
+        msg = FakeMessage(id=next(self._message_ids), chat_id=entity, text=message)
+        self.sent.append((entity, message))
+        return await self(rpc("SendMediaRequest" if file else "SendMessageRequest", result=msg))
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        return await self(rpc("EditMessageRequest", result=FakeMessage(id=message, chat_id=entity, text=text)))
+
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        return await self(rpc("DeleteMessagesRequest"))
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        return await self(rpc("GetMessagesRequest", result=FakeMessage(id=ids, chat_id=entity, text="Broadcast")))
+
+    async def edit_permissions(self, entity, user=None, until_date=None, **kwargs):
+        return await self(rpc("EditBannedRequest"))
+
+    def iter_participants(self, entity, limit=None, filter=None, **kwargs):
+        return FakeParticipants(self, entity, filter)
+
+    async def disconnect(self):
+        pass
+
+# Just what the handlers read from a NewMessage event
+class FakeMessageEvent:
+    def __init__(self, client, chat_id, sender, text, private=False, reply_to=None):
+        self.client = client
+        self.id = next(client._message_ids)
+        self.chat_id = chat_id
+        self.sender_id = sender.id if sender else None
+        self.raw_text = self.text = text
+        self.is_private = private
+        self.is_group = not private
+        self.is_channel = False
+        self.is_reply = reply_to is not None
+        self.pattern_match = None
+        self._sender = sender
+        self._reply_to = reply_to
+
+    async def get_sender(self):
+        return self._sender
+
+    async def get_reply_message(self):
+        return self._reply_to
+
+    async def reply(self, *args, **kwargs):
+        return await self.client.send_message(self.chat_id, *args, reply_to=self.id, **kwargs)
+
+    async def respond(self, *args, **kwargs):
+        return await self.client.send_message(self.chat_id, *args, **kwargs)
+
+    async def delete(self):
+        return await self.client.delete_messages(self.chat_id, [self.id])
+
+# Button press on one of the bot's messages
+class FakeCallbackEvent:
+    def __init__(self, client, chat_id, sender, data, private=False):
+        self.client = client
+        self.id = next(client._message_ids)
+        self.message_id = next(client._message_ids)
+        self.chat_id = chat_id
+        self.sender_id = sender.id if sender else None
+        self.data = data
+        self.is_private = private
+        self.is_group = not private
+        self.is_channel = False
+        self.pattern_match = None
+        self._sender = sender
+
+    async def get_sender(self):
+        return self._sender
+
+    async def answer(self, message=None, cache_time=0, *, url=None, alert=False):
+        return await self.client(rpc("SetBotCallbackAnswerRequest"))
+
+    async def edit(self, *args, **kwargs):
+        return await self.client.edit_message(self.chat_id, self.message_id, *args, **kwargs)
+
+    async def reply(self, *args, **kwargs):
+        return await self.client.send_message(self.chat_id, *args, reply_to=self.message_id, **kwargs)
+
+    async def respond(self, *args, **kwargs):
+        return await self.client.send_message(self.chat_id, *args, **kwargs)
+
+    async def delete(self):
+        return await self.client.delete_messages(self.chat_id, [self.message_id])
+
+# Handlers run one after the other like Telethon does for a single update,
+# and a handler that raises does not stop the rest
+def _accepts(builder, event):
+    if isinstance(event, FakeCallbackEvent):
+        if type(builder) is not events.CallbackQuery:
+            return False
+        if callable(builder.match):
+            event.pattern_match = builder.match(event.data)
+            if not event.pattern_match:
+                return False
+        elif builder.match and builder.match != event.data:
+            return False
+    else:
+        if type(builder) is not events.NewMessage or builder.incoming is False:
+            return False
+        if builder.pattern:
+            event.pattern_match = builder.pattern(event.raw_text)
+            if not event.pattern_match:
+                return False
+    return not builder.func or builder.func(event)
+
+# Run every handler whose filters accept the event; returns how many raised
+async def dispatch(botmod, event):
+    errors = 0
+    for callback, builder in botmod.app.list_event_handlers():
+        if not _accepts(builder, event):
+            continue
+        try:
+            await callback(event)
+        except events.StopPropagation:
+            break
+        except Exception:
+            errors += 1
+            logging.getLogger("bench").exception(f"Unhandled exception in {callback.__name__}")
+    return errors
+
+# Import a fresh copy of bot.py and swap its clients for the fakes. Every
+# module-level collection, and every store holding one, is repointed.
+_sessions = itertools.count(1)
+
+def load_bot(fsub_ids=(), session_dir=None):
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "bench")
+    os.environ["OWNER_ID"] = str(OWNER_ID)
+    os.environ["FSUB"] = " ".join(str(c) for c in fsub_ids)
+    os.environ["SESSION_NAME"] = os.path.join(session_dir or tempfile.gettempdir(), f"bench{next(_sessions)}")
+    os.environ.pop("METRICS_PORT", None)
+    sys.modules.pop("bot", None)
+    botmod = importlib.import_module("bot")
+    logging.getLogger("DURGESH").setLevel(logging.ERROR)
+    return botmod
+
+def install(botmod, client, database, real_budgets=False):
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+    botmod.bot = client
+    botmod.db = database
+    for name, value in list(vars(botmod).items()):
+        if isinstance(value, AsyncIOMotorCollection):
+            setattr(botmod, name, database[value.name])
+        elif isinstance(getattr(value, "collection", None), AsyncIOMotorCollection):
+            value.collection = database[value.collection.name]
+    botmod.INDEXES = [(database[c.name], keys, options) for c, keys, options in botmod.INDEXES]
+
+    if not real_budgets:
+        botmod.RPC_METHOD_DEFAULT_RATE = UNLIMITED
+        botmod.rpc_gateway = botmod.RpcGateway(
+            botmod.RPC_CONCURRENCY, botmod.RPC_BACKGROUND_LIMIT, UNLIMITED, {}
+        )
+        for name, value in list(vars(botmod).items()):
+            if isinstance(value, botmod.TokenBucket):
+                setattr(botmod, name, botmod.TokenBucket(UNLIMITED))
+
+async def load_stores(botmod):
+    await botmod.forcesub_configs.load()
+    await botmod.banned_users.load()
+    await botmod.member_index.load()
+    await botmod.invite_links.load()
+
+# Wait for background work the updates started (flushes, seeding, link
+# exports) so its requests are counted too
+async def drain(timeout=60):
+    current = asyncio.current_task()
+    tasks = [task for task in asyncio.all_tasks() if task is not current]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Run:
+    def __init__(self, name, client, database):
+        self.name = name
+        self.client = client
+        self.database = database
+        self.latencies = []
+        self.updates = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    async def handle(self, botmod, event):
+        start = time.perf_counter()
+        try:
+            self.errors += await dispatch(botmod, event)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+            self.updates += 1
+
+    async def feed(self, botmod, events_, concurrency):
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one(event):
+            async with limit:
+                await self.handle(botmod, event)
+
+        self.started = time.perf_counter()
+        await asyncio.gather(*(one(event) for event in events_))
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def report(self):
+        rpcs = sum(self.client.calls.values())
+        return {
+            "scenario": self.name,
+            "updates": self.updates,
+            "seconds": round(self.elapsed, 3),
+            "updates_per_second": round(self.updates / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 2),
+            "rpcs": rpcs,
+            "rpcs_per_update": round(rpcs / self.updates, 3) if self.updates else 0.0,
+            "errors": self.errors,
+            "rpc_methods": dict(sorted(self.client.calls.items(), key=lambda kv: -kv[1])),
+            "db_ops": self.database.ops(),
+        }
+
+# Scenarios. Each one imports its own bot, loads the stores from the fake
+# database and then measures the updates it feeds in.
+async def setup(args, fsub_ids=()):
+    botmod = load_bot(fsub_ids, args.session_dir)
+    client = FakeClient(botmod, args.latency, args.flood_rate, args.flood_seconds, args.join_rate,
+                        args.users, args.seed)
+    database = FakeDatabase()
+    install(botmod, client, database, args.real_budgets)
+    return botmod, client, database
+
+async def prime(botmod, client, channels, seed):
+    await load_stores(botmod)
+    await botmod.resolver.get_me()
+    if seed:
+        await botmod.member_index.refresh(channels)
+    client.calls.clear()
+
+async def private_storm(args):
+    channels = [channel_id(n) for n in range(1, 3)]
+    botmod, client, database = await setup(args, channels)
+    await prime(botmod, client, channels, args.seed_index)
+
+    rng = random.Random(args.seed)
+    texts = ["/start", "/start", "/help", "/stats"]
+    updates = []
+    for _ in range(args.updates):
+        user = user_entity(rng.randint(OWNER_ID + 1, args.users))
+        updates.append(FakeMessageEvent(client, user.id, user, rng.choice(texts), private=True))
+
+    run = Run("private", client, database)
+    await run.feed(botmod, updates, args.concurrency)
+    await botmod.stats_buffer.close()
+    await drain()
+    run.finish()
+    return run.report()
+
+async def group_firehose(args):
+    channels = [channel_id(n) for n in range(1, 9)]
+    botmod, client, database = await setup(args)
+    rng = random.Random(args.seed)
+    groups = [-1002000000000 - n for n in range(args.groups)]
+    for chat_id in groups:
+        picked = rng.sample(range(1, 9), 2)
+        await database["forcesub"].insert_one({
+            "chat_id": chat_id, "enabled": True, "mode": "multiple",
+            "channels": [{"id": CHANNEL_BASE + n, "title": f"Bench Channel {n}", "username": None} for n in picked]
+        })
+    await prime(botmod, client, channels, args.seed_index)
+
+    updates = []
+    for _ in range(args.updates):
+        user = user_entity(rng.randint(OWNER_ID + 1, args.users))
+        updates.append(FakeMessageEvent(client, rng.choice(groups), user, "hello"))
+
+    run = Run("firehose", client, database)
+    await run.feed(botmod, updates, args.concurrency)
+    await botmod.stats_buffer.close()
+    await drain()
+    run.finish()
+    return run.report()
+
+async def broadcast(args):
+    botmod, client, database = await setup(args)
+    groups = database["groups"]
+    for n in range(args.broadcast_groups):
+        await groups.insert_one({"chat_id": -1003000000000 - n, "total_messages": 0})
+    await prime(botmod, client, [], False)
+
+    run = Run("broadcast", client, database)
+    send_one = botmod.BroadcastJob.send_one
+
+    async def timed_send(job, chat_id):
+        start = time.perf_counter()
+        try:
+            return await send_one(job, chat_id)
+        finally:
+            run.latencies.append(time.perf_counter() - start)
+
+    botmod.BroadcastJob.send_one = timed_send
+    owner = user_entity(OWNER_ID)
+    source = FakeMessage(id=1, chat_id=OWNER_ID, text="Broadcast")
+    event = FakeMessageEvent(client, OWNER_ID, owner, "/broadcast", private=True, reply_to=source)
+    await dispatch(botmod, event)
+    await drain(timeout=None)
+    run.updates = len(run.latencies)
+    run.finish()
+    report = run.report()
+    job = await database["broadcasts"].find_one({})
+    report["broadcast"] = {k: job[k] for k in ("status", "success", "failed", "pruned")}
+    return report
+
+async def join_setup(args):
+    botmod, client, database = await setup(args)
+    await prime(botmod, client, [], False)
+
+    text = "/join " + " ".join(f"@benchchan{n}" for n in range(1, 5))
+    updates = []
+    for n in range(args.joins):
+        chat_id = -1004000000000 - n
+        admin = user_entity(client.group_admin(chat_id))
+        updates.append(FakeMessageEvent(client, chat_id, admin, text))
+
+    run = Run("join", client, database)
+    await run.feed(botmod, updates, args.concurrency)
+    await drain()
+    run.finish()
+    report = run.report()
+    report["configs"] = len(database["forcesub"].docs)
+    return report
+
+SCENARIOS = {
+    "private": private_storm,
+    "firehose": group_firehose,
+    "broadcast": broadcast,
+    "join": join_setup,
+}
+
+def print_table(reports):
+    print(f"{'scenario':<10} {'updates':>8} {'seconds':>8} {'upd/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'rpc/upd':>8}")
+    for r in reports:
+        print(f"{r['scenario']:<10} {r['updates']:>8} {r['seconds']:>8} {r['updates_per_second']:>9} "
+              f"{r['p50_ms']:>8} {r['p99_ms']:>8} {r['rpcs_per_update']:>8}")
+    for r in reports:
+        methods = ", ".join(f"{m} {n}" for m, n in r["rpc_methods"].items())
+        print(f"\n{r['scenario']}: {methods or 'no requests'}")
+        if r["errors"]:
+            print(f"  handler errors: {r['errors']}")
+        for key in ("broadcast", "configs"):
+            if key in r:
+                print(f"  {key}: {r[key]}")
+
+# Options shared with replay.py
+def add_client_options(parser):
+    parser.add_argument("--concurrency", type=int, default=64, help="updates handled at once")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per Telegram request")
+    parser.add_argument("--join-rate", type=float, default=0.8, help="share of users in each channel")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of requests failing with FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--seed-index", action="store_true", help="seed member snapshots before measuring")
+    parser.add_argument("--real-budgets", action="store_true",
+                        help="keep the production rate budgets instead of lifting them")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print reports as JSON")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the force subscription bot")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--updates", type=int, default=10000, help="updates for private and firehose")
+    parser.add_argument("--users", type=int, default=5000, help="distinct users sending updates")
+    parser.add_argument("--groups", type=int, default=200, help="groups with force subscription in firehose")
+    parser.add_argument("--broadcast-groups", type=int, default=50000, help="groups a broadcast goes to")
+    parser.add_argument("--joins", type=int, default=200, help="/join commands with 4 channels")
+    add_client_options(parser)
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    reports = []
+    with tempfile.TemporaryDirectory() as session_dir:
+        args.session_dir = session_dir
+        for name in args.scenarios or SCENARIOS:
+            reports.append(asyncio.run(SCENARIOS[name](args)))
+
+    if args.json:
+        print(json.dumps(reports, indent=2, default=str))
+    else:
+        print_table(reports)
+
+if __name__ == "__main__":
+    main()
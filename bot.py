@@ -1,17 +1,47 @@
 import os
+import re
+import json
+import math
+import hashlib
+import asyncio
 import logging
+import signal
+import threading
+import functools
+import heapq
+import itertools
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from array import array
+from bisect import bisect_left
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 from datetime import datetime, timedelta
-from telethon import TelegramClient, events, Button
-from telethon.tl.functions.channels import GetParticipantRequest
-from telethon.errors import UserNotParticipantError, ChannelPrivateError
-from telethon.tl.types import ChannelParticipantAdmin, ChannelParticipantCreator
+from telethon import TelegramClient, events, Button, utils
+from telethon.tl.functions.channels import GetParticipantRequest, GetFullChannelRequest, ToggleJoinRequestRequest
+from telethon.tl.functions.messages import (
+    ExportChatInviteRequest, GetExportedChatInviteRequest, HideChatJoinRequestRequest
+)
+from telethon.errors import (
+    UserNotParticipantError, ChannelPrivateError, FloodWaitError, ChatWriteForbiddenError,
+    PeerIdInvalidError, ChannelInvalidError, ChatIdInvalidError, ChatRestrictedError,
+    UserIsBlockedError, MessageNotModifiedError, HideRequesterMissingError, UserAlreadyParticipantError,
+    FileReferenceExpiredError, FileReferenceInvalidError, ChatAdminRequiredError,
+    InviteHashExpiredError, InviteHashInvalidError
+)
+from telethon.tl.types import (
+    ChannelParticipantAdmin, ChannelParticipantCreator, ChannelParticipantsAdmins,
+    UpdateChannelParticipant, UpdateChatParticipantAdmin, PeerChannel, PeerChat,
+    ChannelParticipantLeft, ChannelParticipantBanned, UpdateBotChatInviteRequester
+)
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import OperationFailure, ConnectionFailure, ExecutionTimeout, BulkWriteError
+from pymongo import monitoring
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-logger = logging.getLogger(DURGESH)
+logger = logging.getLogger("DURGESH")
 
 # Environment variables with default values
 BOT_TOKEN = os.getenv("BOT_TOKEN", None)
@@ -21,6 +51,656 @@ LOGGER_ID = int(os.getenv("LOGGER_ID", "0"))
 API_ID = int(os.getenv("API_ID", "0"))
 API_HASH = os.getenv("API_HASH", None)
 FSUB = os.getenv("FSUB", "").strip()  # Add force sub channels/groups
+SESSION_NAME = os.getenv("SESSION_NAME", "bot")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the HTTP endpoint
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "")  # record updates for replay.py
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "")  # keeps pseudonyms stable across restarts
+
+# Metrics. Latency histograms are keyed by name and labels; gauges are read
+# from callbacks when rendered. Mongo timings arrive from pymongo's monitor
+# threads, hence the lock.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Upper bound of the bucket holding the q-th quantile
+    def quantile(self, q):
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(METRIC_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # func returns {labels tuple: value}
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def series(self, name):
+        with self._lock:
+            return [(dict(labels), h) for (n, labels), h in self.histograms.items() if n == name]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+            braces = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{name}_sum{braces} {histogram.sum}")
+            lines.append(f"{name}_count{braces} {histogram.count}")
+        for name, func in self.gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                values = func()
+            except Exception as e:
+                logger.debug(f"Gauge {name} failed: {e}")
+                continue
+            for labels, value in values.items():
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                braces = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{name}{braces} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def instrument(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.observe("handler_latency_seconds", {"handler": func.__name__}, time.perf_counter() - start)
+    return wrapper
+
+class MongoCommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe("mongo_command_seconds", {"command": event.command_name}, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.observe("mongo_command_seconds", {"command": event.command_name, "failed": "1"}, event.duration_micros / 1e6)
+
+# Token bucket shared by every rate budget in the bot
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# RPC gateway. Every request the client sends is admitted by lane priority
+# (interactive replies, then enforcement, then background jobs), with a slice
+# of the slots kept out of reach of background work. Requests spend tokens
+# from a global budget and a per-method budget. FloodWaitError pauses that
+# method's budget and the request is retried.
+LANE_INTERACTIVE, LANE_ENFORCEMENT, LANE_BACKGROUND = 0, 1, 2
+LANE_NAMES = ("interactive", "enforcement", "background")
+
+RPC_CONCURRENCY = int(os.getenv("RPC_CONCURRENCY", "16"))
+RPC_BACKGROUND_LIMIT = int(os.getenv("RPC_BACKGROUND_LIMIT", "8"))
+RPC_GLOBAL_RATE = float(os.getenv("RPC_GLOBAL_RATE", "30"))
+RPC_METHOD_DEFAULT_RATE = 20
+RPC_METHOD_RATES = {
+    "SendMessageRequest": 20,
+    "SendMediaRequest": 10,
+    "EditMessageRequest": 10,
+    "EditBannedRequest": 5,
+    "GetParticipantRequest": 25,
+    "ExportChatInviteRequest": 1,
+}
+RPC_RETRIES = 3
+RPC_INTERACTIVE_MAX_WAIT = 10
+
+rpc_lane_var = ContextVar("rpc_lane", default=LANE_INTERACTIVE)
+# Set while a request holds a slot. Telethon resolves uncached peers with
+# nested requests from inside the outer call; those must not queue for a
+# slot their own caller is holding.
+rpc_inside_var = ContextVar("rpc_inside", default=False)
+
+@contextmanager
+def rpc_lane(lane):
+    token = rpc_lane_var.set(lane)
+    try:
+        yield
+    finally:
+        rpc_lane_var.reset(token)
+
+class RpcGateway:
+    def __init__(self, concurrency, background_limit, global_rate, method_rates):
+        self.free = concurrency
+        self.background_limit = background_limit
+        self.global_bucket = TokenBucket(global_rate)
+        self.method_rates = method_rates
+        self.method_buckets = {}
+        self.in_flight = [0, 0, 0]
+        self.queued = [0, 0, 0]
+        self.calls = defaultdict(int)
+        self.flood_waits = defaultdict(int)
+        self.paused_until = {}
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _bucket(self, method):
+        bucket = self.method_buckets.get(method)
+        if bucket is None:
+            bucket = self.method_buckets[method] = TokenBucket(self.method_rates.get(method, RPC_METHOD_DEFAULT_RATE))
+        return bucket
+
+    def _can_run(self, lane):
+        return self.free > 0 and (lane != LANE_BACKGROUND or self.in_flight[lane] < self.background_limit)
+
+    def _take(self, lane):
+        self.free -= 1
+        self.in_flight[lane] += 1
+
+    def _release(self, lane):
+        self.free += 1
+        self.in_flight[lane] -= 1
+        skipped = []
+        while self._waiters and self.free > 0:
+            entry = heapq.heappop(self._waiters)
+            waiter_lane, _, future = entry
+            if future.done():
+                continue
+            if not self._can_run(waiter_lane):
+                skipped.append(entry)
+                continue
+            self._take(waiter_lane)
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+    async def _acquire(self, lane):
+        if self._can_run(lane) and (not self._waiters or self._waiters[0][0] > lane):
+            self._take(lane)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), future))
+        self.queued[lane] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancel
+            if future.done() and not future.cancelled():
+                self._release(lane)
+            raise
+        finally:
+            self.queued[lane] -= 1
+
+    async def _send(self, send, method, bucket):
+        await self.global_bucket.acquire()
+        await bucket.acquire()
+        self.calls[method] += 1
+        start = time.perf_counter()
+        token = rpc_inside_var.set(True)
+        try:
+            return await send()
+        finally:
+            rpc_inside_var.reset(token)
+            metrics.observe("telegram_rpc_seconds", {"method": method}, time.perf_counter() - start)
+
+    # FloodWaits pause the method for the lane that hit them only, so a
+    # broadcast's wait never holds back interactive replies. An interactive
+    # request facing a long pause fails right away instead of waiting.
+    async def _wait_pause(self, lane, method, request):
+        wait = self.paused_until.get((lane, method), 0) - time.monotonic()
+        if wait <= 0:
+            return
+        if lane == LANE_INTERACTIVE and wait > RPC_INTERACTIVE_MAX_WAIT:
+            raise FloodWaitError(request, capture=math.ceil(wait))
+        await asyncio.sleep(wait)
+
+    async def call(self, send, request):
+        lane = rpc_lane_var.get()
+        method = type(request).__name__ if not isinstance(request, list) else "batch"
+        bucket = self._bucket(method)
+        if rpc_inside_var.get():
+            return await self._send(send, method, bucket)
+        for attempt in range(RPC_RETRIES + 1):
+            await self._wait_pause(lane, method, request)
+            await self._acquire(lane)
+            try:
+                return await self._send(send, method, bucket)
+            except FloodWaitError as e:
+                self.flood_waits[method] += 1
+                key = (lane, method)
+                self.paused_until[key] = max(self.paused_until.get(key, 0), time.monotonic() + e.seconds)
+                if attempt == RPC_RETRIES or (lane == LANE_INTERACTIVE and e.seconds > RPC_INTERACTIVE_MAX_WAIT):
+                    raise
+                logger.warning(f"FloodWait of {e.seconds}s on {method} ({LANE_NAMES[lane]}), retrying")
+            finally:
+                self._release(lane)
+
+    def stats(self):
+        return {
+            "queued": dict(zip(LANE_NAMES, self.queued)),
+            "in_flight": dict(zip(LANE_NAMES, self.in_flight)),
+            "calls": dict(self.calls),
+            "flood_waits": dict(self.flood_waits),
+        }
+
+rpc_gateway = RpcGateway(RPC_CONCURRENCY, RPC_BACKGROUND_LIMIT, RPC_GLOBAL_RATE, RPC_METHOD_RATES)
+
+# Telethon funnels every high-level call (send_message, event.reply, ...)
+# through __call__, so wrapping it puts all traffic behind the gateway
+class ScheduledClient(TelegramClient):
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        send = super().__call__
+        return await rpc_gateway.call(lambda: send(request, ordered, flood_sleep_threshold), request)
+
+# Clients
+bot = ScheduledClient(SESSION_NAME, API_ID, API_HASH, flood_sleep_threshold=0)
+app = bot
+
+# Guarded database access for the collections handlers touch. Operations
+# run under a timeout and a cap on how many are in flight. Repeated failures
+# open the breaker: reads then fail fast with DatabaseUnavailable so callers
+# answer from their in-memory caches, and writes go to a bounded journal that
+# is replayed in order once a probe gets through. Journaled writes must be
+# safe to apply twice, since one that timed out may have landed anyway.
+MONGO_OP_TIMEOUT = float(os.getenv("MONGO_OP_TIMEOUT", "5"))
+MONGO_CONCURRENCY = int(os.getenv("MONGO_CONCURRENCY", "64"))
+MONGO_JOURNAL_SIZE = int(os.getenv("MONGO_JOURNAL_SIZE", "10000"))
+MONGO_BREAKER_THRESHOLD = 5
+MONGO_BREAKER_COOLDOWN = 15
+
+# Errors that say the database is unreachable, not that the request was bad
+MONGO_DOWN_ERRORS = (ConnectionFailure, ExecutionTimeout, asyncio.TimeoutError)
+
+class DatabaseUnavailable(Exception):
+    pass
+
+class MongoBreaker:
+    def __init__(self, timeout, concurrency, threshold, cooldown, journal_size):
+        self.timeout = timeout
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.journal = deque()
+        self.journal_size = journal_size
+        self.dropped = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._probing = False
+        self._replaying = None
+
+    @property
+    def closed(self):
+        return self.opened_at is None
+
+    # Closed, or open long enough that one probe may go through
+    def _admit(self):
+        if self.opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self._probing = True
+        return True
+
+    def _succeeded(self):
+        self._probing = False
+        self.failures = 0
+        if self.opened_at is not None:
+            self.opened_at = None
+            logger.info(f"Database reachable again, replaying {len(self.journal)} journaled writes")
+        if self.journal:
+            self.schedule_replay()
+
+    def _failed(self, error):
+        self._probing = False
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.threshold:
+            logger.error(f"Database unreachable after {self.failures} failures, answering from memory: {error!r}")
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    async def _run(self, func):
+        async with self._slots:
+            return await func()
+
+    # Any answer from the server, errors included, shows it is reachable
+    async def call(self, func):
+        if not self._admit():
+            raise DatabaseUnavailable("circuit open")
+        reached = False
+        try:
+            result = await asyncio.wait_for(self._run(func), self.timeout)
+            reached = True
+            return result
+        except MONGO_DOWN_ERRORS as e:
+            self._failed(e)
+            raise DatabaseUnavailable(repr(e)) from e
+        except Exception:
+            reached = True
+            raise
+        finally:
+            self._probing = False
+            if reached:
+                self._succeeded()
+
+    # Writes queue behind anything already journaled so they land in order
+    async def write(self, collection, method, *args, **kwargs):
+        if not self.journal:
+            try:
+                return await self.call(lambda: getattr(collection, method)(*args, **kwargs))
+            except DatabaseUnavailable:
+                pass
+        if len(self.journal) >= self.journal_size:
+            self.journal.popleft()
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Write journal full, dropped {self.dropped} writes so far")
+        self.journal.append((collection, method, args, kwargs))
+        if self.closed:
+            self.schedule_replay()
+
+    def schedule_replay(self):
+        if self._replaying is None or self._replaying.done():
+            self._replaying = asyncio.ensure_future(self.replay())
+        return self._replaying
+
+    async def replay(self):
+        replayed = 0
+        while self.journal:
+            collection, method, args, kwargs = self.journal[0]
+            try:
+                await self.call(lambda: getattr(collection, method)(*args, **kwargs))
+            except DatabaseUnavailable:
+                logger.warning(f"Journal replay paused after {replayed} writes, {len(self.journal)} left")
+                return
+            except Exception as e:
+                logger.error(f"Dropping journaled {method} on {collection.name}: {e}")
+            self.journal.popleft()
+            replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} journaled writes")
+
+    # While open, probe on a timer so the journal drains even when no
+    # handler is asking for the database
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.cooldown)
+            if not self.closed or self.journal:
+                try:
+                    await self.call(lambda: db.command("ping"))
+                except DatabaseUnavailable:
+                    pass
+
+class GuardedCursor:
+    def __init__(self, breaker, cursor):
+        self.breaker = breaker
+        self.cursor = cursor
+        self._batch = 1000
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, count):
+        self.cursor = self.cursor.limit(count)
+        return self
+
+    def batch_size(self, size):
+        self._batch = size
+        self.cursor = self.cursor.batch_size(size)
+        return self
+
+    async def to_list(self, length=None):
+        return await self.breaker.call(lambda: self.cursor.to_list(length))
+
+    # One timeout per batch rather than per document
+    async def __aiter__(self):
+        while True:
+            batch = await self.to_list(self._batch)
+            if not batch:
+                return
+            for doc in batch:
+                yield doc
+
+class GuardedCollection:
+    def __init__(self, collection, breaker):
+        self.collection = collection
+        self.breaker = breaker
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    def find(self, *args, **kwargs):
+        return GuardedCursor(self.breaker, self.collection.find(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return await self.breaker.call(lambda: self.collection.find_one(*args, **kwargs))
+
+    async def count_documents(self, *args, **kwargs):
+        return await self.breaker.call(lambda: self.collection.count_documents(*args, **kwargs))
+
+    # Batched writes come from the write-behind buffer, which keeps and
+    # merges them itself, so they fail fast instead of filling the journal
+    async def bulk_write(self, *args, **kwargs):
+        return await self.breaker.call(lambda: self.collection.bulk_write(*args, **kwargs))
+
+    async def insert_one(self, *args, **kwargs):
+        return await self.breaker.write(self.collection, "insert_one", *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self.breaker.write(self.collection, "update_one", *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self.breaker.write(self.collection, "delete_one", *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self.breaker.write(self.collection, "delete_many", *args, **kwargs)
+
+    # Change streams, index builds and admin aggregations go straight to motor
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+mongo_breaker = MongoBreaker(
+    MONGO_OP_TIMEOUT, MONGO_CONCURRENCY, MONGO_BREAKER_THRESHOLD, MONGO_BREAKER_COOLDOWN, MONGO_JOURNAL_SIZE
+)
+
+mongo_client = AsyncIOMotorClient(
+    MONGO_URI, event_listeners=[MongoCommandTimer()],
+    serverSelectionTimeoutMS=int(MONGO_OP_TIMEOUT * 1000)
+)
+db = mongo_client["ForceSubBot"]
+users_collection = GuardedCollection(db["users"], mongo_breaker)
+groups_collection = GuardedCollection(db["groups"], mongo_breaker)
+forcesub_collection = GuardedCollection(db["forcesub"], mongo_breaker)
+invite_links_collection = db["invite_links"]
+broadcasts_collection = db["broadcasts"]
+channel_members_collection = db["channel_members"]
+join_requests_collection = db["join_requests"]
+group_stats_collection = db["group_stats"]
+channel_health_collection = db["channel_health"]
+audit_mutes_collection = db["audit_mutes"]
+
+# Update capture for load testing. Incoming messages and button presses are
+# appended to CAPTURE_FILE as short JSON lines. Ids become salted hashes of
+# the same shape, command arguments are hashed unless they are keywords the
+# commands understand and other message text is kept only as its length. The handlers
+# are registered before all others so timestamps are arrival times.
+CAPTURE_FLUSH_INTERVAL = 1
+CAPTURE_ID_RE = re.compile(r"-?\d+")
+# Argument words kept in clear; anything else could be a username
+CAPTURE_KEYWORDS = frozenset(("off", "disable", "mute", "restrict", "requests", "messages"))
+
+class UpdateRecorder:
+    def __init__(self, path, salt):
+        self.path = path
+        self.salt = hashlib.sha256((salt or os.urandom(16).hex()).encode()).digest()
+        self._lines = []
+
+    def _hash(self, value):
+        digest = hashlib.blake2b(str(value).encode(), key=self.salt, digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    # Users stay positive, basic groups negative and channels -100...
+    def pseudonym(self, peer_id):
+        peer_id = int(peer_id)
+        n = self._hash(abs(peer_id)) % 10 ** 9 + 1
+        if peer_id <= -10 ** 12:
+            return -(10 ** 12 + n)
+        return -n if peer_id < 0 else n
+
+    def _token(self, token):
+        if token.lstrip("-").isdigit():
+            return str(self.pseudonym(token))
+        if token.lower() in CAPTURE_KEYWORDS:
+            return token
+        return f"@a{self._hash(token.lower()) % 16 ** 8:08x}"
+
+    def _entry(self, kind, event):
+        entry = {"t": round(time.time(), 3), "k": kind, "c": self.pseudonym(event.chat_id)}
+        if event.sender_id:
+            entry["u"] = self.pseudonym(event.sender_id)
+            if event.sender_id == OWNER_ID:
+                entry["o"] = 1
+        if event.is_private:
+            entry["p"] = 1
+        return entry
+
+    def record_message(self, event):
+        entry = self._entry("m", event)
+        text = event.raw_text or ""
+        match = COMMAND_RE.match(text)
+        if match:
+            prefix, name, _, args = match.groups()
+            entry["x"] = " ".join([prefix + name] + [self._token(t) for t in (args or "").split()])
+        else:
+            entry["n"] = len(text)
+        if event.is_reply:
+            entry["r"] = 1
+        self._lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def record_callback(self, event):
+        entry = self._entry("c", event)
+        data = event.data.decode(errors="replace")
+        entry["d"] = CAPTURE_ID_RE.sub(lambda m: str(self.pseudonym(m.group())), data)
+        self._lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def flush(self):
+        if not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"Could not write update capture: {e}")
+
+update_recorder = UpdateRecorder(CAPTURE_FILE, CAPTURE_SALT) if CAPTURE_FILE else None
+
+async def capture_message(event):
+    update_recorder.record_message(event)
+
+async def capture_callback(event):
+    update_recorder.record_callback(event)
+
+if update_recorder:
+    app.add_event_handler(capture_message, events.NewMessage(incoming=True))
+    app.add_event_handler(capture_callback, events.CallbackQuery())
+
+# Indexes every query in the bot relies on: (collection, keys, options)
+INDEXES = [
+    (users_collection, [("user_id", ASCENDING)], {"unique": True}),
+    (users_collection, [("banned", ASCENDING)], {"partialFilterExpression": {"banned": True}}),
+    (groups_collection, [("chat_id", ASCENDING)], {"unique": True}),
+    (forcesub_collection, [("chat_id", ASCENDING)], {"unique": True}),
+    (invite_links_collection, [("channel_id", ASCENDING)], {"unique": True}),
+    (broadcasts_collection, [("status", ASCENDING)], {}),
+    (channel_members_collection, [("channel_id", ASCENDING), ("chunk", ASCENDING)], {"unique": True}),
+    (join_requests_collection, [("requested_at", ASCENDING)], {}),
+    (group_stats_collection, [("chat_id", ASCENDING), ("unit", ASCENDING), ("start", ASCENDING)], {"unique": True}),
+    (group_stats_collection, [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+]
+
+async def ensure_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Could not create index {keys} on {collection.name}: {e}")
+
+# Document counts, sizes and per-index usage for the owner's /dbstats
+async def collection_report():
+    lines = []
+    for collection in (users_collection, groups_collection, forcesub_collection,
+                       invite_links_collection, broadcasts_collection, channel_members_collection,
+                       join_requests_collection, group_stats_collection, channel_health_collection,
+                       audit_mutes_collection):
+        try:
+            stats = await db.command("collStats", collection.name)
+            usage = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        except Exception as e:
+            lines.append(f"**{collection.name}:** `{str(e)}`")
+            continue
+        lines.append(
+            f"**{collection.name}:** {stats.get('count', 0)} docs, "
+            f"{stats.get('size', 0) // 1024} KB data, {stats.get('totalIndexSize', 0) // 1024} KB indexes"
+        )
+        for index in usage:
+            lines.append(f"  • `{index['name']}`: {index['accesses']['ops']} ops")
+    return "\n".join(lines)
 
 # Parse force sub channels/groups
 FSUB_IDS = []
@@ -34,70 +714,1139 @@ if FSUB:
     except:
         logger.error("Invalid FSUB format. Should be space-separated channel IDs.")
 
+# Membership verdict cache: (user_id, channel_id) -> joined?
+# Positive verdicts live longer than negative ones so a user who just joined
+# is not locked out for long, and the "I've joined" button can force a recheck.
+FSUB_CACHE_POSITIVE_TTL = int(os.getenv("FSUB_CACHE_POSITIVE_TTL", "600"))
+FSUB_CACHE_NEGATIVE_TTL = int(os.getenv("FSUB_CACHE_NEGATIVE_TTL", "30"))
+FSUB_CACHE_SIZE = int(os.getenv("FSUB_CACHE_SIZE", "100000"))
+
+class VerdictCache:
+    def __init__(self, positive_ttl, negative_ttl, maxsize):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, channel_id):
+        key = (user_id, channel_id)
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        joined, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return joined
+
+    def set(self, user_id, channel_id, joined):
+        ttl = self.positive_ttl if joined else self.negative_ttl
+        key = (user_id, channel_id)
+        self._data[key] = (joined, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id, channel_ids=None):
+        if channel_ids is None:
+            channel_ids = [c for u, c in self._data if u == user_id]
+        for channel_id in channel_ids:
+            self._data.pop((user_id, channel_id), None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+verdict_cache = VerdictCache(FSUB_CACHE_POSITIVE_TTL, FSUB_CACHE_NEGATIVE_TTL, FSUB_CACHE_SIZE)
+
+# Ask Telegram and cache the verdict. Concurrent checks for the same
+# (user, channel) pair share one request. Rechecks the user asked for pass
+# fresh=True to skip the member snapshot, which can miss a recent join; the
+# answer is written back so the snapshot is corrected too.
+_membership_checks = {}
+
+async def _fetch_membership(user_id, channel_id, fresh):
+    joined = None if fresh else member_index.lookup(user_id, channel_id)
+    if joined is not None:
+        verdict_cache.set(user_id, channel_id, joined)
+        return joined
+    try:
+        await bot(GetParticipantRequest(channel=channel_id, participant=user_id))
+        joined = True
+    except UserNotParticipantError:
+        joined = False
+    verdict_cache.set(user_id, channel_id, joined)
+    member_index.apply(channel_id, user_id, joined)
+    return joined
+
+def fetch_membership(user_id, channel_id, fresh=False):
+    key = (user_id, channel_id, fresh)
+    task = _membership_checks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_membership(user_id, channel_id, fresh))
+        _membership_checks[key] = task
+        task.add_done_callback(lambda _: _membership_checks.pop(key, None))
+    return task
+
+# Check a single channel, going to Telegram only on a cache miss
+async def is_member(user_id, channel_id):
+    joined = verdict_cache.get(user_id, channel_id)
+    if joined is not None:
+        return joined
+    return await fetch_membership(user_id, channel_id)
+
+# Run func over items with at most `limit` calls in flight. Failures are
+# collected per item instead of aborting the whole batch.
+FANOUT_LIMIT = int(os.getenv("FANOUT_LIMIT", "8"))
+
+class FanoutResult:
+    def __init__(self, results):
+        self.ok = [(item, value) for item, value, error in results if error is None]
+        self.failed = [(item, error) for item, value, error in results if error is not None]
+
+async def fanout(func, items, limit=FANOUT_LIMIT):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return item, await func(item), None
+            except Exception as e:
+                return item, None, e
+
+    return FanoutResult(await asyncio.gather(*(run(item) for item in items)))
+
+# Shared entity resolver. The bot's own user is fetched once at startup and
+# channel entities are kept in an LRU with a TTL, under both the key they
+# were asked for and their peer id. Concurrent lookups of one key share a
+# single request.
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", "3600"))
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "5000"))
+
+class EntityResolver:
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.me = None
+        self._entities = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(key):
+        if isinstance(key, str):
+            key = key.strip()
+            for prefix in ("https://t.me/", "http://t.me/", "t.me/", "@"):
+                if key.startswith(prefix):
+                    key = key[len(prefix):]
+            if key.lstrip("-").isdigit():
+                return int(key)
+            return key.lower()
+        return key
+
+    async def get_me(self):
+        if self.me is None:
+            self.me = await bot.get_me()
+        return self.me
+
+    def _store(self, key, entity):
+        expires = time.monotonic() + self.ttl
+        for k in (key, utils.get_peer_id(entity)):
+            self._entities[k] = (entity, expires)
+            self._entities.move_to_end(k)
+        while len(self._entities) > self.maxsize:
+            self._entities.popitem(last=False)
+
+    async def _fetch(self, key):
+        entity = await bot.get_entity(key)
+        self._store(key, entity)
+        return entity
+
+    async def get(self, key):
+        key = self._key(key)
+        entry = self._entities.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entities.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entities[key]
+        self.misses += 1
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await task
+
+    def invalidate(self, key):
+        self._entities.pop(self._key(key), None)
+
+resolver = EntityResolver(ENTITY_CACHE_TTL, ENTITY_CACHE_SIZE)
+
 # Add new function to check owner's force sub
 async def check_owner_fsub(user_id):
     if not FSUB_IDS or user_id == OWNER_ID:
         return True
-        
-    missing_subs = []
-    for channel_id in FSUB_IDS:
+
+    checks = await fanout(lambda channel_id: is_member(user_id, channel_id), FSUB_IDS)
+    for channel_id, error in checks.failed:
+        logger.warning(f"Membership check failed for {user_id} in {channel_id}: {error}")
+
+    not_joined = [channel_id for channel_id, joined in checks.ok if not joined]
+    entities = await fanout(resolver.get, not_joined)
+    return [channel for _, channel in entities.ok]
+
+# Invite links per channel, exported once and reused until they are about to
+# expire instead of minting a new link for every denied user.
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", str(7 * 24 * 3600)))
+INVITE_LINK_REFRESH_BEFORE = int(os.getenv("INVITE_LINK_REFRESH_BEFORE", str(24 * 3600)))
+INVITE_LINK_CHECK_INTERVAL = 60
+
+class InviteLinkStore:
+    def __init__(self, collection, ttl, refresh_before):
+        self.collection = collection
+        self.ttl = ttl
+        self.refresh_before = refresh_before
+        self._links = {}
+        self._pending = {}
+        self._checked = {}
+
+    async def load(self):
+        now = time.time()
+        async for doc in self.collection.find(
+            {"expires_at": {"$gt": now}},
+            {"_id": 0, "channel_id": 1, "link": 1, "expires_at": 1}
+        ):
+            self._links[doc["channel_id"]] = (doc["link"], doc["expires_at"])
+        logger.info(f"Loaded {len(self._links)} cached invite links")
+
+    # Cached link or None, never an RPC. Links close to expiry are refreshed
+    # in the background while the current one is still handed out.
+    def peek(self, channel_id):
+        entry = self._links.get(channel_id)
+        if entry is None:
+            return None
+        link, expires_at = entry
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            return None
+        if remaining < self.refresh_before:
+            self.refresh(channel_id).add_done_callback(lambda task: self._log_failure(channel_id, task))
+        return link
+
+    async def get_link(self, channel_id):
+        link = self.peek(channel_id)
+        if link:
+            return link
+        return await self.refresh(channel_id)
+
+    # Concurrent refreshes of the same channel share one export
+    def refresh(self, channel_id):
+        task = self._pending.get(channel_id)
+        if task is None:
+            task = asyncio.ensure_future(self._export(channel_id))
+            self._pending[channel_id] = task
+            task.add_done_callback(lambda _: self._pending.pop(channel_id, None))
+        return task
+
+    async def _export(self, channel_id):
+        expires_at = time.time() + self.ttl
+        invite = await bot(ExportChatInviteRequest(channel_id, expire_date=int(expires_at)))
+        self._links[channel_id] = (invite.link, expires_at)
+        await self.collection.update_one(
+            {"channel_id": channel_id},
+            {"$set": {"link": invite.link, "expires_at": expires_at}},
+            upsert=True
+        )
+        return invite.link
+
+    def _log_failure(self, channel_id, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Background invite link work for {channel_id} failed: {task.exception()!r}")
+
+    # Ask Telegram whether the cached link still works and drop it if an
+    # admin revoked it. Each channel is checked at most once a minute.
+    async def check(self, channel_id):
+        entry = self._links.get(channel_id)
+        now = time.monotonic()
+        if entry is None or now - self._checked.get(channel_id, 0) < INVITE_LINK_CHECK_INTERVAL:
+            return
+        self._checked[channel_id] = now
         try:
-            await bot(GetParticipantRequest(channel=channel_id, participant=user_id))
-        except UserNotParticipantError:
+            result = await bot(GetExportedChatInviteRequest(channel_id, entry[0]))
+            revoked = result.invite.revoked
+        except (InviteHashExpiredError, InviteHashInvalidError):
+            revoked = True
+        if revoked:
+            logger.info(f"Invite link for {channel_id} was revoked, exporting a new one when needed")
+            await self.invalidate(channel_id)
+
+    def schedule_check(self, channel_ids):
+        for channel_id in channel_ids:
+            if channel_id in self._links:
+                task = asyncio.ensure_future(self.check(channel_id))
+                task.add_done_callback(lambda task, channel_id=channel_id: self._log_failure(channel_id, task))
+
+    async def invalidate(self, channel_id):
+        if self._links.pop(channel_id, None) is not None:
+            await self.collection.delete_one({"channel_id": channel_id})
+
+invite_links = InviteLinkStore(invite_links_collection, INVITE_LINK_TTL, INVITE_LINK_REFRESH_BEFORE)
+
+# Force subscription configs, all held in memory. Writes go through to Mongo
+# and a change stream (or periodic reload) picks up edits made elsewhere.
+FORCESUB_RELOAD_INTERVAL = int(os.getenv("FORCESUB_RELOAD_INTERVAL", "300"))
+FORCESUB_PROJECTION = {
+    "_id": 1, "chat_id": 1, "channel_id": 1, "channel_username": 1,
+    "mode": 1, "channels": 1, "enabled": 1, "action": 1, "gate": 1, "gate_toggled": 1, "degraded": 1
+}
+
+class ForceSubConfigStore:
+    def __init__(self, collection, reload_interval):
+        self.collection = collection
+        self.reload_interval = reload_interval
+        self._configs = {}
+        self._ids = {}
+
+    async def load(self):
+        configs, ids = {}, {}
+        async for doc in self.collection.find({}, FORCESUB_PROJECTION).batch_size(1000):
+            ids[doc["_id"]] = doc["chat_id"]
+            configs[doc.pop("chat_id")] = doc
+            doc.pop("_id")
+        self._configs, self._ids = configs, ids
+        logger.info(f"Loaded {len(configs)} force subscription configs")
+
+    def get(self, chat_id):
+        return self._configs.get(chat_id)
+
+    def items(self):
+        return self._configs.items()
+
+    async def update(self, chat_id, fields, upsert=True):
+        await self.collection.update_one({"chat_id": chat_id}, {"$set": fields}, upsert=upsert)
+        fields = {k: v for k, v in fields.items() if k != "chat_id"}
+        config = self._configs.get(chat_id)
+        if config is not None:
+            config.update(fields)
+        elif upsert:
+            self._configs[chat_id] = fields
+
+    async def delete(self, chat_id):
+        await self.collection.delete_one({"chat_id": chat_id})
+        self._configs.pop(chat_id, None)
+
+    def _apply(self, change):
+        operation = change["operationType"]
+        if operation == "delete":
+            chat_id = self._ids.pop(change["documentKey"]["_id"], None)
+            self._configs.pop(chat_id, None)
+        elif operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            if not doc or "chat_id" not in doc:
+                return
+            self._ids[doc["_id"]] = doc["chat_id"]
+            self._configs[doc["chat_id"]] = {
+                k: v for k, v in doc.items() if k in FORCESUB_PROJECTION and k not in ("_id", "chat_id")
+            }
+
+    async def watch(self):
+        while True:
             try:
-                channel = await bot.get_entity(channel_id)
-                missing_subs.append(channel)
-            except:
-                continue
-    return missing_subs
-
-# Add event handler for all messages
-@app.on(events.NewMessage)
-async def check_fsub_handler(event):
-    if event.is_private and event.raw_text.startswith('/'):
-        user_id = event.sender_id
-        missing_subs = await check_owner_fsub(user_id)
-        
-        if missing_subs is True:
+                async with self.collection.watch(full_document="updateLookup") as stream:
+                    async for change in stream:
+                        self._apply(change)
+            except OperationFailure:
+                # Standalone servers have no change streams
+                logger.info("Change streams unavailable, polling force subscription configs")
+                while True:
+                    await asyncio.sleep(self.reload_interval)
+                    await self.reload()
+            except Exception as e:
+                logger.warning(f"Force subscription config watch failed: {e}")
+                await asyncio.sleep(5)
+                await self.reload()
+
+    # Keep serving the cached configs while the database is away
+    async def reload(self):
+        try:
+            await self.load()
+        except DatabaseUnavailable as e:
+            logger.warning(f"Keeping cached force subscription configs: {e}")
+
+forcesub_configs = ForceSubConfigStore(forcesub_collection, FORCESUB_RELOAD_INTERVAL)
+
+# Admin roster per chat, fetched once and then kept current from participant
+# updates. The TTL only guards against updates we never received.
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "3600"))
+
+class AdminCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._rosters = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, chat_id):
+        entry = self._rosters.get(chat_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        task = self._pending.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(chat_id))
+            self._pending[chat_id] = task
+            task.add_done_callback(lambda _: self._pending.pop(chat_id, None))
+        return await task
+
+    async def _fetch(self, chat_id):
+        admins = set()
+        async for admin in bot.iter_participants(chat_id, filter=ChannelParticipantsAdmins):
+            admins.add(admin.id)
+        self._rosters[chat_id] = (admins, time.monotonic() + self.ttl)
+        return admins
+
+    # Only touch rosters we already hold; unknown chats load lazily
+    def add(self, chat_id, user_id):
+        entry = self._rosters.get(chat_id)
+        if entry is not None:
+            entry[0].add(user_id)
+
+    def discard(self, chat_id, user_id):
+        entry = self._rosters.get(chat_id)
+        if entry is not None:
+            entry[0].discard(user_id)
+
+    def invalidate(self, chat_id):
+        self._rosters.pop(chat_id, None)
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL)
+
+async def is_admin(chat_id, user_id):
+    try:
+        return user_id in await admin_cache.get(chat_id)
+    except Exception as e:
+        logger.warning(f"Could not load admins of {chat_id}: {e}")
+        return False
+
+# Keep admin rosters in sync with promotions, demotions and departures
+@app.on(events.Raw(UpdateChannelParticipant))
+@instrument
+async def channel_participant_update(update):
+    chat_id = utils.get_peer_id(PeerChannel(update.channel_id))
+    if isinstance(update.new_participant, (ChannelParticipantAdmin, ChannelParticipantCreator)):
+        admin_cache.add(chat_id, update.user_id)
+    else:
+        admin_cache.discard(chat_id, update.user_id)
+
+@app.on(events.Raw(UpdateChatParticipantAdmin))
+@instrument
+async def chat_participant_admin_update(update):
+    chat_id = utils.get_peer_id(PeerChat(update.chat_id))
+    if update.is_admin:
+        admin_cache.add(chat_id, update.user_id)
+    else:
+        admin_cache.discard(chat_id, update.user_id)
+
+@app.on(events.ChatAction)
+@instrument
+async def admin_chat_action(event):
+    if event.user_left or event.user_kicked:
+        for user_id in event.user_ids:
+            admin_cache.discard(event.chat_id, user_id)
+    elif event.user_added or event.user_joined:
+        if (await resolver.get_me()).id in event.user_ids:
+            admin_cache.invalidate(event.chat_id)
+
+# Member snapshots of required channels where the bot is admin. Each channel
+# is seeded by one participant walk, stored as a sorted int64 array plus small
+# add/remove sets fed by participant updates, and persisted in chunks. A hit
+# answers a membership check without a GetParticipantRequest; when the walk
+# did not see every member, a miss still falls through to Telegram.
+MEMBER_INDEX_MAX_AGE = int(os.getenv("MEMBER_INDEX_MAX_AGE", str(24 * 3600)))
+MEMBER_INDEX_SAVE_INTERVAL = int(os.getenv("MEMBER_INDEX_SAVE_INTERVAL", "600"))
+MEMBER_INDEX_CHUNK = 250000
+
+class ChannelMembers:
+    def __init__(self, members, complete, seeded_at):
+        self.members = members
+        self.complete = complete
+        self.seeded_at = seeded_at
+        self.added = set()
+        self.removed = set()
+
+    def __contains__(self, user_id):
+        if user_id in self.removed:
+            return False
+        if user_id in self.added:
+            return True
+        i = bisect_left(self.members, user_id)
+        return i < len(self.members) and self.members[i] == user_id
+
+    def add(self, user_id):
+        self.removed.discard(user_id)
+        self.added.add(user_id)
+
+    def discard(self, user_id):
+        self.added.discard(user_id)
+        self.removed.add(user_id)
+
+    @property
+    def dirty(self):
+        return bool(self.added or self.removed)
+
+    # Fold the pending changes back into the sorted array
+    def compact(self):
+        if self.dirty:
+            merged = (set(self.members) - self.removed) | self.added
+            self.members = array("q", sorted(merged))
+            self.added, self.removed = set(), set()
+
+class MemberIndex:
+    def __init__(self, collection):
+        self.collection = collection
+        self._channels = {}
+        self._seeding = set()
+
+    # True/False when the snapshot knows, None when Telegram has to be asked
+    def lookup(self, user_id, channel_id):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return None
+        if user_id in channel:
+            return True
+        return False if channel.complete else None
+
+    def apply(self, channel_id, user_id, joined):
+        channel = self._channels.get(channel_id)
+        if channel is None:
             return
-            
-        if missing_subs:
-            buttons = []
-            for channel in missing_subs:
-                if hasattr(channel, 'username') and channel.username:
-                    buttons.append([Button.url(f"Join {channel.title}", f"https://t.me/{channel.username}")])
-                else:
-                    try:
-                        from telethon.tl.functions.messages import ExportChatInviteRequest
-                        invite = await bot(ExportChatInviteRequest(channel.id))
-                        buttons.append([Button.url(f"Join {channel.title}", invite.link)])
-                    except:
-                        continue
-            
-            await event.reply(
-                "**⚠️ ᴀᴄᴄᴇss ʀᴇsᴛʀɪᴄᴛᴇᴅ ⚠️**\n\n"
-                "**ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴏᴜʀ ᴄʜᴀɴɴᴇʟ(s) ᴛᴏ ᴜsᴇ ᴛʜᴇ ʙᴏᴛ!**\n"
-                "**ᴄʟɪᴄᴋ ᴛʜᴇ ʙᴜᴛᴛᴏɴs ʙᴇʟᴏᴡ ᴛᴏ ᴊᴏɪɴ**\n"
-                "**ᴛʜᴇɴ ᴛʀʏ ᴀɢᴀɪɴ!**",
-                buttons=buttons
+        if joined:
+            channel.add(user_id)
+        else:
+            channel.discard(user_id)
+
+    async def load(self):
+        chunks = {}
+        async for doc in self.collection.find({}, {"_id": 0}).sort([("channel_id", 1), ("chunk", 1)]):
+            chunks.setdefault(doc["channel_id"], []).append(doc)
+        for channel_id, docs in chunks.items():
+            members = array("q")
+            for doc in docs:
+                members.frombytes(doc["members"])
+            self._channels[channel_id] = ChannelMembers(members, docs[0]["complete"], docs[0]["seeded_at"])
+        logger.info(f"Loaded member snapshots for {len(chunks)} channels")
+
+    async def seed(self, channel_id):
+        if channel_id in self._seeding:
+            return
+        self._seeding.add(channel_id)
+        try:
+            members = array("q")
+            participants = bot.iter_participants(channel_id)
+            async for user in participants:
+                members.append(user.id)
+            members = array("q", sorted(set(members)))
+            complete = len(members) >= (participants.total or 0)
+            self._channels[channel_id] = ChannelMembers(members, complete, time.time())
+            await self.save(channel_id)
+            logger.info(f"Seeded {len(members)} members of {channel_id} (complete: {complete})")
+        except Exception as e:
+            logger.warning(f"Could not seed members of {channel_id}: {e}")
+        finally:
+            self._seeding.discard(channel_id)
+
+    async def save(self, channel_id):
+        channel = self._channels[channel_id]
+        channel.compact()
+        data = channel.members
+        chunks = max(1, (len(data) + MEMBER_INDEX_CHUNK - 1) // MEMBER_INDEX_CHUNK)
+        for chunk in range(chunks):
+            part = data[chunk * MEMBER_INDEX_CHUNK:(chunk + 1) * MEMBER_INDEX_CHUNK]
+            await self.collection.update_one(
+                {"channel_id": channel_id, "chunk": chunk},
+                {"$set": {"members": part.tobytes(), "complete": channel.complete, "seeded_at": channel.seeded_at}},
+                upsert=True
             )
+        await self.collection.delete_many({"channel_id": channel_id, "chunk": {"$gte": chunks}})
+
+    # Seed channels that have no snapshot or an old one, one at a time
+    async def refresh(self, channel_ids):
+        with rpc_lane(LANE_BACKGROUND):
+            for channel_id in channel_ids:
+                channel = self._channels.get(channel_id)
+                if channel is None or time.time() - channel.seeded_at > MEMBER_INDEX_MAX_AGE:
+                    await self.seed(channel_id)
+
+    def schedule_refresh(self, channel_ids):
+        return asyncio.ensure_future(self.refresh(list(channel_ids)))
+
+    async def run(self):
+        while True:
+            channel_ids = set(FSUB_IDS)
+            for _, config in forcesub_configs.items():
+                channel_ids.update(required_channels(config))
+            await self.refresh(channel_ids)
+
+            await asyncio.sleep(MEMBER_INDEX_SAVE_INTERVAL)
+            for channel_id, channel in list(self._channels.items()):
+                if channel.dirty:
+                    try:
+                        await self.save(channel_id)
+                    except Exception as e:
+                        logger.warning(f"Could not save members of {channel_id}: {e}")
+
+member_index = MemberIndex(channel_members_collection)
+
+# Keep snapshots and cached verdicts current as members join and leave
+@app.on(events.Raw(UpdateChannelParticipant))
+@instrument
+async def channel_member_update(update):
+    channel_id = utils.get_peer_id(PeerChannel(update.channel_id))
+    participant = update.new_participant
+    joined = participant is not None and not isinstance(participant, (ChannelParticipantLeft, ChannelParticipantBanned))
+    member_index.apply(channel_id, update.user_id, joined)
+    verdict_cache.set(update.user_id, channel_id, joined)
+
+# Command rate limiting. Every user gets a token bucket across all commands
+# plus one per command, kept in small __slots__ records. Records are ordered
+# by last use so idle users can be dropped from the front; an idle bucket has
+# refilled anyway, so forgetting it changes nothing.
+RATE_LIMIT_GLOBAL = (1.0, 5)  # tokens per second, burst
+RATE_LIMIT_DEFAULT = (0.5, 3)
+RATE_LIMITS = {
+    "start": (0.2, 2),
+    "stats": (0.2, 2),
+    "status": (0.2, 2),
+    "join": (0.1, 2),
+}
+RATE_LIMIT_IDLE = int(os.getenv("RATE_LIMIT_IDLE", "300"))
+RATE_LIMIT_NOTICE_INTERVAL = 30
+
+class RateBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, rate, capacity, now):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class RateRecord:
+    __slots__ = ("bucket", "commands", "seen", "warned")
+
+    def __init__(self, now):
+        self.bucket = RateBucket(RATE_LIMIT_GLOBAL[1], now)
+        self.commands = None
+        self.seen = now
+        self.warned = None
+
+class RateLimiter:
+    def __init__(self, idle):
+        self.idle = idle
+        self._records = OrderedDict()
+
+    def _evict(self, now):
+        records = self._records
+        while records:
+            user_id, record = next(iter(records.items()))
+            if now - record.seen < self.idle:
+                break
+            del records[user_id]
+
+    def limited(self, user_id, command=None):
+        now = time.monotonic()
+        self._evict(now)
+        record = self._records.get(user_id)
+        if record is None:
+            record = self._records[user_id] = RateRecord(now)
+        else:
+            self._records.move_to_end(user_id)
+        record.seen = now
+
+        if command is not None:
+            rate, capacity = RATE_LIMITS.get(command, RATE_LIMIT_DEFAULT)
+            if record.commands is None:
+                record.commands = {}
+            bucket = record.commands.get(command)
+            if bucket is None:
+                bucket = record.commands[command] = RateBucket(capacity, now)
+            if not bucket.take(rate, capacity, now):
+                return True
+        return not record.bucket.take(RATE_LIMIT_GLOBAL[0], RATE_LIMIT_GLOBAL[1], now)
+
+    # One "please wait" notice per interval, however fast the user keeps sending
+    def should_warn(self, user_id):
+        record = self._records.get(user_id)
+        if record is None:
+            return True
+        now = time.monotonic()
+        if record.warned is not None and now - record.warned < RATE_LIMIT_NOTICE_INTERVAL:
+            return False
+        record.warned = now
+        return True
+
+    def __len__(self):
+        return len(self._records)
+
+rate_limiter = RateLimiter(RATE_LIMIT_IDLE)
+
+async def is_rate_limited(user_id, command=None):
+    if user_id == OWNER_ID:
+        return False
+    return rate_limiter.limited(user_id, command)
+
+# Write-behind buffer for stats. Updates are merged per document in memory
+# and flushed with one unordered bulk_write per collection, either every
+# STATS_FLUSH_INTERVAL seconds or once STATS_FLUSH_SIZE documents are dirty.
+# Failed updates are kept and merged into the next flush. A flush that times
+# out may still have been applied, so its counts are written again: counters
+# are at-least-once and can overcount after a timeout, but never lose counts.
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+STATS_FLUSH_SIZE = int(os.getenv("STATS_FLUSH_SIZE", "1000"))
+
+class WriteBehindBuffer:
+    def __init__(self, flush_interval, flush_size):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._flushing = None
+
+    def _entry(self, collection, query):
+        key = (collection.name, tuple(sorted(query.items())))
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = (collection, query, {})
+            if len(self._pending) >= self.flush_size:
+                self.schedule_flush()
+        return entry[2]
+
+    def inc(self, collection, query, **fields):
+        update = self._entry(collection, query).setdefault("$inc", {})
+        for field, amount in fields.items():
+            update[field] = update.get(field, 0) + amount
+
+    def set(self, collection, query, **fields):
+        self._entry(collection, query).setdefault("$set", {}).update(fields)
+
+    def set_on_insert(self, collection, query, **fields):
+        self._entry(collection, query).setdefault("$setOnInsert", {}).update(fields)
+
+    def max(self, collection, query, **fields):
+        update = self._entry(collection, query).setdefault("$max", {})
+        for field, value in fields.items():
+            if value > update.get(field, value - 1):
+                update[field] = value
+
+    def schedule_flush(self):
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self.flush())
+        return self._flushing
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        batches = {}
+        for collection, query, update in pending.values():
+            batches.setdefault(collection.name, (collection, []))[1].append((query, update))
+        for collection, updates in batches.values():
+            try:
+                await collection.bulk_write(
+                    [UpdateOne(query, update, upsert=True) for query, update in updates],
+                    ordered=False
+                )
+            except BulkWriteError as e:
+                # The batch is unordered, so every update not listed was applied
+                failed = [updates[error["index"]] for error in e.details.get("writeErrors", [])]
+                logger.error(f"Stats flush to {collection.name}: {len(failed)} of {len(updates)} updates failed, "
+                             f"keeping them: {e}")
+                for query, update in failed:
+                    self._requeue(collection, query, update)
+            except Exception as e:
+                logger.error(f"Stats flush to {collection.name} failed, keeping {len(updates)} updates: {e}")
+                for query, update in updates:
+                    self._requeue(collection, query, update)
+
+    def _requeue(self, collection, query, update):
+        entry = self._entry(collection, query)
+        for field, amount in update.get("$inc", {}).items():
+            inc = entry.setdefault("$inc", {})
+            inc[field] = inc.get(field, 0) + amount
+        for field, value in update.get("$max", {}).items():
+            maxed = entry.setdefault("$max", {})
+            maxed[field] = max(maxed.get(field, value), value)
+        for op in ("$set", "$setOnInsert"):
+            if op in update:
+                merged = dict(update[op])
+                merged.update(entry.get(op, {}))
+                entry[op] = merged
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.schedule_flush()
+
+    async def close(self):
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+
+stats_buffer = WriteBehindBuffer(STATS_FLUSH_INTERVAL, STATS_FLUSH_SIZE)
+
+def update_user_stats(user_id, username, first_name):
+    query = {"user_id": user_id}
+    stats_buffer.set(users_collection, query, username=username, first_name=first_name, last_seen=datetime.utcnow())
+    stats_buffer.set_on_insert(users_collection, query, joined_at=datetime.utcnow())
+
+# Time-bucketed group stats. Each message is counted in an hourly and a
+# daily bucket per group, and the sender goes into a HyperLogLog sketch of
+# that bucket for approximate distinct users. The group document keeps one
+# more sketch covering its whole lifetime. Registers are stored sparse as
+# {index: rank} and merged with $max, so flushes never read the bucket back.
+STATS_HLL_BITS = 10  # 1024 registers, about 3% error
+STATS_HOURS_KEPT = 48
+STATS_DAYS_KEPT = int(os.getenv("STATS_DAYS_KEPT", "90"))
+STATS_WINDOWS = (("24h", "h", timedelta(hours=24)), ("7d", "d", timedelta(days=7)), ("30d", "d", timedelta(days=30)))
+
+# (register index, rank) for a user id, from a 64-bit mix of the id
+def hll_register(value):
+    h = (value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    h ^= h >> 31
+    rest_bits = 64 - STATS_HLL_BITS
+    return h >> rest_bits, rest_bits - (h & ((1 << rest_bits) - 1)).bit_length() + 1
+
+def hll_estimate(registers):
+    m = 1 << STATS_HLL_BITS
+    zeros = m - len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / (zeros + sum(2.0 ** -rank for rank in registers.values()))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return round(estimate)
+
+def stats_buckets(now):
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    return (("h", hour, hour + timedelta(hours=STATS_HOURS_KEPT)),
+            ("d", day, day + timedelta(days=STATS_DAYS_KEPT)))
+
+# The $max update that adds a user to an "hll" sketch field
+def hll_fields(user_id):
+    index, rank = hll_register(user_id)
+    return {f"hll.{index}": rank}
+
+def record_group_activity(chat_id, user_id):
+    register = hll_fields(user_id) if user_id else None
+    for unit, start, expires_at in stats_buckets(datetime.utcnow()):
+        query = {"chat_id": chat_id, "unit": unit, "start": start}
+        stats_buffer.inc(group_stats_collection, query, messages=1)
+        stats_buffer.set_on_insert(group_stats_collection, query, expires_at=expires_at)
+        if register:
+            stats_buffer.max(group_stats_collection, query, **register)
+
+# Messages and approximate active users for each of STATS_WINDOWS, from at
+# most 24 hourly and 30 daily buckets
+async def group_activity(chat_id):
+    hour, day = (start for _, start, _ in stats_buckets(datetime.utcnow()))
+    projection = {"_id": 0, "unit": 1, "start": 1, "messages": 1, "hll": 1}
+    buckets = await group_stats_collection.find({"$or": [
+        {"chat_id": chat_id, "unit": "h", "start": {"$gt": hour - timedelta(hours=24)}},
+        {"chat_id": chat_id, "unit": "d", "start": {"$gt": day - timedelta(days=30)}},
+    ]}, projection).to_list(None)
+
+    windows = {}
+    for name, unit, span in STATS_WINDOWS:
+        since = (hour if unit == "h" else day) - span
+        messages, registers = 0, {}
+        for bucket in buckets:
+            if bucket["unit"] != unit or bucket["start"] <= since:
+                continue
+            messages += bucket.get("messages", 0)
+            for index, rank in (bucket.get("hll") or {}).items():
+                if rank > registers.get(index, 0):
+                    registers[index] = rank
+        windows[name] = (messages, hll_estimate(registers))
+    return windows
+
+@app.on(events.NewMessage(incoming=True, func=lambda e: e.is_group))
+@instrument
+async def track_group_message(event):
+    record_group_activity(event.chat_id, event.sender_id)
+    query = {"chat_id": event.chat_id}
+    stats_buffer.inc(groups_collection, query, total_messages=1)
+    if event.sender_id:
+        stats_buffer.max(groups_collection, query, **hll_fields(event.sender_id))
+
+# Join prompts, one live prompt per (chat, user). A user who keeps triggering
+# the prompt gets nothing new inside the cooldown; after it the existing
+# prompt is edited if its content changed, and once it is old enough to have
+# scrolled away it is replaced by a fresh one.
+PROMPT_COOLDOWN = int(os.getenv("PROMPT_COOLDOWN", "30"))
+PROMPT_REFRESH = int(os.getenv("PROMPT_REFRESH", "300"))
+PROMPTS_TRACKED = 50000
+
+class Prompt:
+    __slots__ = ("message_id", "content", "sent_at", "shown_at")
+
+    def __init__(self, message_id, content, now):
+        self.message_id = message_id
+        self.content = content
+        self.sent_at = self.shown_at = now
+
+class PromptTracker:
+    def __init__(self, cooldown, refresh, maxsize):
+        self.cooldown = cooldown
+        self.refresh = refresh
+        self.maxsize = maxsize
+        self._prompts = OrderedDict()
+        self.counts = defaultdict(int)
+
+    # True while the user's last prompt is too recent to show another
+    def cooling_down(self, chat_id, user_id):
+        prompt = self._prompts.get((chat_id, user_id))
+        if prompt is not None and time.monotonic() - prompt.shown_at < self.cooldown:
+            self.counts["suppressed"] += 1
             return True
-    return False
+        return False
+
+    async def _edit(self, chat_id, prompt, text, buttons):
+        try:
+            await bot.edit_message(chat_id, prompt.message_id, text, buttons=buttons)
+        except MessageNotModifiedError:
+            pass
+        except Exception as e:
+            # Most likely deleted by the user or an admin
+            logger.debug(f"Could not edit prompt {prompt.message_id} in {chat_id}: {e}")
+            return False
+        return True
+
+    async def show(self, chat_id, user_id, text, buttons):
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        content = (text, repr(buttons))
+        prompt = self._prompts.get(key)
+        if prompt is not None and now - prompt.sent_at < self.refresh:
+            if prompt.content == content:
+                self.counts["kept"] += 1
+                prompt.shown_at = now
+                return
+            if await self._edit(chat_id, prompt, text, buttons):
+                self.counts["edited"] += 1
+                prompt.content, prompt.shown_at = content, now
+                return
+        elif prompt is not None:
+            try:
+                await bot.delete_messages(chat_id, [prompt.message_id])
+            except Exception as e:
+                logger.debug(f"Could not delete old prompt in {chat_id}: {e}")
+
+        message = await bot.send_message(chat_id, text, buttons=buttons)
+        self.counts["sent"] += 1
+        self._prompts[key] = Prompt(message.id, content, now)
+        self._prompts.move_to_end(key)
+        while len(self._prompts) > self.maxsize:
+            self._prompts.popitem(last=False)
+
+    def forget(self, chat_id, user_id):
+        self._prompts.pop((chat_id, user_id), None)
+
+prompts = PromptTracker(PROMPT_COOLDOWN, PROMPT_REFRESH, PROMPTS_TRACKED)
+
+# Join prompt for private commands from users missing the bot's own FSUB
+# channels. Returns True when the command should not run.
+async def fsub_gate(event, user_id):
+    missing_subs = await check_owner_fsub(user_id)
+    if missing_subs is True or not missing_subs:
+        return False
+    if prompts.cooling_down(event.chat_id, user_id):
+        return True
+
+    buttons = []
+    for channel in missing_subs:
+        if hasattr(channel, 'username') and channel.username:
+            buttons.append([Button.url(f"Join {channel.title}", f"https://t.me/{channel.username}")])
+        else:
+            try:
+                link = await invite_links.get_link(utils.get_peer_id(channel))
+                buttons.append([Button.url(f"Join {channel.title}", link)])
+            except:
+                continue
+    buttons.append([Button.inline("✅ ɪ'ᴠᴇ ᴊᴏɪɴᴇᴅ", data="fsub_recheck")])
+
+    await prompts.show(
+        event.chat_id, user_id,
+        "**⚠️ ᴀᴄᴄᴇss ʀᴇsᴛʀɪᴄᴛᴇᴅ ⚠️**\n\n"
+        "**ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴏᴜʀ ᴄʜᴀɴɴᴇʟ(s) ᴛᴏ ᴜsᴇ ᴛʜᴇ ʙᴏᴛ!**\n"
+        "**ᴄʟɪᴄᴋ ᴛʜᴇ ʙᴜᴛᴛᴏɴs ʙᴇʟᴏᴡ ᴛᴏ ᴊᴏɪɴ**\n"
+        "**ᴛʜᴇɴ ᴛʀʏ ᴀɢᴀɪɴ!**",
+        buttons
+    )
+    return True
+
+# Banned users, loaded once through the partial banned index and kept in
+# step by /ban and /unban, so the ban check never leaves memory
+class BannedUsers:
+    def __init__(self, collection):
+        self.collection = collection
+        self._ids = set()
+
+    async def load(self):
+        ids = set()
+        async for doc in self.collection.find({"banned": True}, {"_id": 0, "user_id": 1}).batch_size(5000):
+            ids.add(doc["user_id"])
+        self._ids = ids
+        logger.info(f"Loaded {len(ids)} banned users")
+
+    async def ban(self, user_id):
+        await self.collection.update_one({"user_id": user_id}, {"$set": {"banned": True}}, upsert=True)
+        self._ids.add(user_id)
+
+    async def unban(self, user_id):
+        await self.collection.update_one({"user_id": user_id}, {"$set": {"banned": False}})
+        self._ids.discard(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+banned_users = BannedUsers(users_collection)
+
+def is_banned(user_id):
+    return user_id in banned_users
+
+# Command router. Each command update is parsed once and runs the shared
+# checks (owner, ban, rate limit, FSUB, admin) a single time; the handler
+# gets the results in a CommandContext instead of repeating them.
+COMMAND_RE = re.compile(r"^([/!.])(\w+)(?:@(\w+))?(?:\s+(.*))?$", re.DOTALL)
+
+class Command:
+    __slots__ = ("func", "prefixes", "owner", "admin", "fsub")
+
+    def __init__(self, func, prefixes, owner, admin, fsub):
+        self.func = func
+        self.prefixes = prefixes
+        self.owner = owner
+        self.admin = admin
+        self.fsub = fsub
+
+class CommandContext:
+    __slots__ = ("command", "args", "user_id", "chat_id", "sender", "is_owner", "is_admin")
+
+    def __init__(self, command, args, user_id, chat_id, sender):
+        self.command = command
+        self.args = args
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.sender = sender
+        self.is_owner = user_id == OWNER_ID
+        self.is_admin = self.is_owner
+
+commands = {}
 
-# Modify all command handlers to check FSUB first
-@app.on(events.NewMessage(pattern="/start"))
-async def start_command(event):
-    if await check_fsub_handler(event):
+# owner: silently ignore everyone but OWNER_ID
+# admin: resolve ctx.is_admin for group chats
+# fsub: gate private use behind the bot's own FSUB channels
+def command(*names, prefixes="/", owner=False, admin=False, fsub=True):
+    def decorator(func):
+        timed = instrument(func)
+        for name in names:
+            commands[name] = Command(timed, prefixes, owner, admin, fsub)
+        return func
+    return decorator
+
+@app.on(events.NewMessage(incoming=True, pattern=r"^[/!.]\w"))
+@instrument
+async def command_router(event):
+    match = COMMAND_RE.match(event.raw_text)
+    if not match:
         return
-    if await is_rate_limited(event.sender_id):
-        return await event.reply("**⚠️ Please wait a moment before using commands again!**")
-        
-    await update_user_stats(event.sender_id, event.sender.username, event.sender.first_name)
+    prefix, name, mention, args = match.groups()
+    name = name.lower()
+    cmd = commands.get(name)
+    if cmd is None or prefix not in cmd.prefixes:
+        return
+    if mention and mention.lower() != ((await resolver.get_me()).username or "").lower():
+        return
+
+    user_id = event.sender_id
+    ctx = CommandContext(name, (args or "").strip(), user_id, event.chat_id, await event.get_sender())
+
+    if cmd.owner:
+        if not ctx.is_owner:
+            return
+    elif not ctx.is_owner:
+        if is_banned(user_id):
+            return
+        if await is_rate_limited(user_id, name):
+            if rate_limiter.should_warn(user_id):
+                await event.reply("**⚠️ Please wait a moment before using commands again!**")
+            return
+        if cmd.fsub and event.is_private and await fsub_gate(event, user_id):
+            return
+
+    if cmd.admin and event.is_group and not ctx.is_owner:
+        ctx.is_admin = await is_admin(ctx.chat_id, user_id)
+
+    await cmd.func(event, ctx)
+
+# Shared by every "I've joined" button: drop the user's cached verdicts and
+# ask Telegram again. A user still missing a channel is told so, and the
+# invite links on those buttons are checked in case they were revoked. On
+# success the join prompt is forgotten and the caller sends its own answer.
+async def recheck_membership(event, user_id, channels):
+    verdict_cache.invalidate(user_id, channels)
+    checks = await fanout(lambda channel_id: fetch_membership(user_id, channel_id, fresh=True), channels)
+    for channel_id, error in checks.failed:
+        logger.warning(f"Membership recheck failed for {user_id} in {channel_id}: {error}")
+    not_joined = [channel_id for channel_id, joined in checks.ok if not joined]
+    if not_joined or checks.failed:
+        invite_links.schedule_check(not_joined)
+        await event.answer("❌ ʏᴏᴜ ʜᴀᴠᴇɴ'ᴛ ᴊᴏɪɴᴇᴅ ᴀʟʟ ᴄʜᴀɴɴᴇʟs ʏᴇᴛ!", alert=True)
+        return False
+    prompts.forget(event.chat_id, user_id)
+    return True
+
+@app.on(events.CallbackQuery(pattern="fsub_recheck"))
+@instrument
+async def fsub_recheck_callback(event):
+    user_id = event.sender_id
+    if user_id != OWNER_ID and not await recheck_membership(event, user_id, FSUB_IDS):
+        return
+    await event.answer("✅ ᴛʜᴀɴᴋs ғᴏʀ ᴊᴏɪɴɪɴɢ! ʏᴏᴜ ᴄᴀɴ ɴᴏᴡ ᴜsᴇ ᴛʜᴇ ʙᴏᴛ.", alert=True)
+    await event.delete()
+
+# Start command
+@command("start")
+async def start_command(event, ctx):
+    update_user_stats(ctx.user_id, ctx.sender.username, ctx.sender.first_name)
     
     if event.is_private:
-        me = await bot.get_me()
+        me = await resolver.get_me()
         await event.reply(
-            f"👋 **Hello {event.sender.first_name}!**\n\n"
+            f"👋 **Hello {ctx.sender.first_name}!**\n\n"
             f"I am a Force Subscription Bot. Add me to your group and I'll make sure new members join your channel before chatting.\n\n"
             f"**Commands:**\n"
             f"• /setjoin - Setup force subscription (Single/Multiple channels)\n"
@@ -116,291 +1865,336 @@ async def start_command(event):
         await event.reply("I'm alive! Use /help to see available commands.")
 
 # Stats command
-@app.on(events.NewMessage(pattern="/stats"))
-async def stats_command(event):
-    if await check_fsub_handler(event):
-        return
+@command("stats", admin=True)
+async def stats_command(event, ctx):
     if not event.is_group:
         return
-        
-    if await is_rate_limited(event.sender_id):
-        return await event.reply("**⚠️ Please wait a moment before using commands again!**")
 
-    chat_id = event.chat_id
-    user_id = event.sender_id
+    chat_id = ctx.chat_id
     
-    if not await is_admin(chat_id, user_id) and user_id != OWNER_ID:
+    if not ctx.is_admin:
         return await event.reply("**🚫 Only admins can use this command!**")
     
-    group_data = await groups_collection.find_one({"chat_id": chat_id})
+    if not mongo_breaker.closed:
+        return await event.reply("**⚠️ Statistics are unavailable right now, try again in a minute.**")
+
+    # Counts still sitting in the write-behind buffer go out first
+    await stats_buffer.schedule_flush()
+    try:
+        group_data, windows = await asyncio.gather(
+            groups_collection.find_one({"chat_id": chat_id}, {"_id": 0, "total_messages": 1, "hll": 1}),
+            group_activity(chat_id)
+        )
+    except DatabaseUnavailable:
+        return await event.reply("**⚠️ Statistics are unavailable right now, try again in a minute.**")
     if not group_data:
         return await event.reply("**❌ No statistics available for this group.**")
     
     total_messages = group_data.get("total_messages", 0)
-    active_users = group_data.get("active_users", 0)
+    active_users = hll_estimate(group_data.get("hll") or {})
+    recent = "".join(
+        f"**Last {name}:** {messages} messages, ~{users} active users\n"
+        for name, (messages, users) in windows.items()
+    )
     
     await event.reply(
         f"**📊 Group Statistics**\n\n"
+        f"{recent}\n"
         f"**Total Messages:** {total_messages}\n"
-        f"**Active Users:** {active_users}\n"
-        f"**Force Sub Status:** {'Enabled' if await forcesub_collection.find_one({'chat_id': chat_id}) else 'Disabled'}"
+        f"**Active Users:** ~{active_users}\n"
+        f"**Force Sub Status:** {'Enabled' if forcesub_configs.get(chat_id) else 'Disabled'}"
     )
 
+# Broadcast jobs. Groups are walked in chat_id order one page at a time,
+# sent concurrently under a global token bucket, and the cursor is saved after
+# every page so a restart resumes where the job left off. A job whose saves
+# keep failing stops but stays "running", and is resumed later.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # messages per second
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_PROGRESS_INTERVAL = 15
+BROADCAST_SAVE_RETRIES = 5
+
+# Errors meaning the bot can no longer post in that chat
+BROADCAST_GONE_ERRORS = (
+    ChatWriteForbiddenError, ChannelPrivateError, PeerIdInvalidError,
+    ChannelInvalidError, ChatIdInvalidError, ChatRestrictedError, UserIsBlockedError
+)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+class BroadcastJob:
+    def __init__(self, doc):
+        self.doc = doc
+        self.message = None
+        self.last_progress = 0
+
+    # FloodWaits are retried and paced by the gateway; one that outlasts its
+    # retries counts as a failed send
+    async def send_one(self, chat_id):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, self.message)
+            return "sent"
+        except BROADCAST_GONE_ERRORS:
+            return "gone"
+        except Exception as e:
+            logger.debug(f"Broadcast to {chat_id} failed: {e}")
+            return "failed"
+
+    async def save(self, **fields):
+        self.doc.update(fields)
+        for attempt in range(BROADCAST_SAVE_RETRIES + 1):
+            try:
+                return await broadcasts_collection.update_one({"_id": self.doc["_id"]}, {"$set": fields})
+            except MONGO_DOWN_ERRORS as e:
+                if attempt == BROADCAST_SAVE_RETRIES:
+                    raise
+                delay = min(2 ** attempt, MONGO_BREAKER_COOLDOWN)
+                logger.warning(f"Could not save broadcast {self.doc['_id']}, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_progress < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        doc = self.doc
+        title = "📢 Broadcast Completed" if final else "📢 Broadcast In Progress"
+        try:
+            await bot.edit_message(
+                doc["progress_chat"], doc["progress_message_id"],
+                f"**{title}**\n\n"
+                f"**Success:** {doc['success']}\n"
+                f"**Failed:** {doc['failed']}\n"
+                f"**Removed:** {doc['pruned']}"
+            )
+        except MessageNotModifiedError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not update broadcast progress: {e}")
+
+    async def run(self):
+        doc = self.doc
+        self.message = await bot.get_messages(doc["source_chat"], ids=doc["message_id"])
+        if not self.message:
+            await self.save(status="failed")
+            return await self.report(final=True)
+
+        while True:
+            query = {"chat_id": {"$gt": doc["cursor"]}} if doc["cursor"] is not None else {}
+            try:
+                page = await groups_collection.find(query, {"_id": 0, "chat_id": 1}) \
+                    .sort("chat_id", 1).limit(BROADCAST_PAGE_SIZE).to_list(BROADCAST_PAGE_SIZE)
+            except DatabaseUnavailable:
+                await asyncio.sleep(MONGO_BREAKER_COOLDOWN)
+                continue
+            if not page:
+                break
+
+            results = await fanout(self.send_one, [group["chat_id"] for group in page], BROADCAST_CONCURRENCY)
+            outcomes = [outcome for _, outcome in results.ok]
+            gone = [chat_id for chat_id, outcome in results.ok if outcome == "gone"]
+            if gone:
+                await groups_collection.delete_many({"chat_id": {"$in": gone}})
+
+            await self.save(
+                cursor=page[-1]["chat_id"],
+                success=doc["success"] + outcomes.count("sent"),
+                failed=doc["failed"] + outcomes.count("failed") + len(results.failed),
+                pruned=doc["pruned"] + len(gone)
+            )
+            await self.report()
+
+        await self.save(status="done", finished_at=datetime.utcnow())
+        await self.report(final=True)
+
+BROADCAST_PROJECTION = {
+    "source_chat": 1, "message_id": 1, "progress_chat": 1, "progress_message_id": 1,
+    "cursor": 1, "success": 1, "failed": 1, "pruned": 1
+}
+
+# Broadcasts running in this process, by job id
+broadcast_jobs = {}
+
+def start_broadcast(doc):
+    async def run():
+        try:
+            with rpc_lane(LANE_BACKGROUND):
+                await BroadcastJob(doc).run()
+        except MONGO_DOWN_ERRORS as e:
+            logger.error(f"Broadcast {doc['_id']} interrupted, left running to resume: {e}")
+        except Exception as e:
+            logger.error(f"Broadcast {doc['_id']} stopped: {e}")
+            try:
+                await broadcasts_collection.update_one({"_id": doc["_id"]}, {"$set": {"status": "failed"}})
+            except Exception as e:
+                logger.error(f"Could not mark broadcast {doc['_id']} failed: {e}")
+        finally:
+            broadcast_jobs.pop(doc["_id"], None)
+    task = broadcast_jobs[doc["_id"]] = asyncio.ensure_future(run())
+    return task
+
+# Pick up jobs that were running when the bot went down
+async def resume_broadcasts():
+    async for doc in broadcasts_collection.find({"status": "running"}, BROADCAST_PROJECTION):
+        logger.info(f"Resuming broadcast {doc['_id']} after chat {doc['cursor']}")
+        start_broadcast(doc)
+
 # Broadcast command
-@app.on(events.NewMessage(pattern="/broadcast"))
-async def broadcast_command(event):
-    if event.sender_id != OWNER_ID:
-        return
-        
+@command("broadcast", owner=True)
+async def broadcast_command(event, ctx):
     if not event.is_reply:
         return await event.reply("**❌ Please reply to a message to broadcast!**")
+
+    if broadcast_jobs:
+        return await event.reply("**⚠️ A broadcast is already running!**")
+    # A job still marked running here was interrupted by the database, so
+    # finish it before starting another
+    await resume_broadcasts()
+    if broadcast_jobs:
+        return await event.reply("**⚠️ An interrupted broadcast was resumed, try again once it finishes!**")
     
     message = await event.get_reply_message()
-    all_groups = groups_collection.find({})
-    
-    success = 0
-    failed = 0
-    
-    async for group in all_groups:
-        try:
-            await bot.send_message(group["chat_id"], message)
-            success += 1
-        except Exception:
-            failed += 1
-            
-    await event.reply(
-        f"**📢 Broadcast Completed**\n\n"
-        f"**Success:** {success}\n"
-        f"**Failed:** {failed}"
-    )
+    progress = await event.reply("**📢 Broadcast Started**")
+
+    doc = {
+        "_id": f"{event.chat_id}:{message.id}:{int(time.time())}",
+        "status": "running",
+        "source_chat": event.chat_id,
+        "message_id": message.id,
+        "progress_chat": event.chat_id,
+        "progress_message_id": progress.id,
+        "cursor": None,
+        "success": 0,
+        "failed": 0,
+        "pruned": 0,
+        "started_at": datetime.utcnow()
+    }
+    await broadcasts_collection.insert_one(doc)
+    start_broadcast(doc)
 
 # Ban command
-@app.on(events.NewMessage(pattern="/ban"))
-async def ban_command(event):
-    if event.sender_id != OWNER_ID:
-        return
-        
-    if not event.is_reply and len(event.raw_text.split()) == 1:
+@command("ban", owner=True)
+async def ban_command(event, ctx):
+    if not event.is_reply and not ctx.args:
         return await event.reply("**❌ Please reply to a user's message or provide a user ID to ban!**")
     
     try:
         if event.is_reply:
             user_id = (await event.get_reply_message()).sender_id
         else:
-            user_id = int(event.raw_text.split()[1])
+            user_id = int(ctx.args.split()[0])
             
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"banned": True}},
-            upsert=True
-        )
+        await banned_users.ban(user_id)
         
         await event.reply(f"**✅ User {user_id} has been banned from using the bot!**")
     except Exception as e:
         await event.reply(f"**❌ Error: {str(e)}**")
 
 # Unban command
-@app.on(events.NewMessage(pattern="/unban"))
-async def unban_command(event):
-    if event.sender_id != OWNER_ID:
-        return
-        
-    if not event.is_reply and len(event.raw_text.split()) == 1:
+@command("unban", owner=True)
+async def unban_command(event, ctx):
+    if not event.is_reply and not ctx.args:
         return await event.reply("**❌ Please reply to a user's message or provide a user ID to unban!**")
     
     try:
         if event.is_reply:
             user_id = (await event.get_reply_message()).sender_id
         else:
-            user_id = int(event.raw_text.split()[1])
+            user_id = int(ctx.args.split()[0])
             
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"banned": False}}
-        )
+        await banned_users.unban(user_id)
         
         await event.reply(f"**✅ User {user_id} has been unbanned!**")
     except Exception as e:
         await event.reply(f"**❌ Error: {str(e)}**")
 
+# Database report
+@command("dbstats", owner=True)
+async def dbstats_command(event, ctx):
+    await event.reply(f"**🗄 Database Statistics**\n\n{await collection_report()}")
+
 # Help command
-@app.on(events.NewMessage(pattern="/help"))
-async def help_command(event):
+@command("help")
+async def help_command(event, ctx):
     await event.reply(
         "**📚 Force Subscription Bot Help**\n\n"
         "**Admin Commands:**\n"
         "• /join <channel username or ID> - Set force subscription\n"
         "• /join off - Disable force subscription\n"
-        "• /status - Check current force subscription status\n\n"
-        "**How to use:**\n"
-        "1. Add me to your group as admin\n"
-        "2. Add me to your channel as admin with 'Invite Users' permission\n"
-        "3. Use /join command in your group to set force subscription"
-    )
-
-# Status command
-@app.on(events.NewMessage(pattern="/status"))
-async def status_command(event):
-    if await check_fsub_handler(event):
-        return
-    if not event.is_group:
-        return
-        
-    chat_id = event.chat_id
-    user_id = event.sender_id
-    
-    # Check if user is admin
-    is_admin = False
-    async for admin in app.iter_participants(chat_id, filter=ChannelParticipantAdmin):
-        if admin.id == user_id:
-            is_admin = True
-            break
-    
-    if not (is_admin or user_id == event.chat.creator or user_id == OWNER_ID):
-        return await event.reply("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs ᴏʀ sᴜᴅᴏᴇʀs ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
-    
-    forcesub_data = await forcesub_collection.find_one({"chat_id": chat_id})
-    if not forcesub_data:
-        return await event.reply("**ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs ɴᴏᴛ ᴇɴᴀʙʟᴇᴅ ɪɴ ᴛʜɪs ɢʀᴏᴜᴘ.**")
-    
-    try:
-        channel_id = forcesub_data["channel_id"]
-        channel_info = await bot.get_entity(int(channel_id))
-        channel_title = channel_info.title
-        channel_username = forcesub_data["channel_username"]
-        
-        await event.reply(
-            f"**ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs ᴄᴜʀʀᴇɴᴛʟʏ ᴇɴᴀʙʟᴇᴅ ɪɴ ᴛʜɪs ɢʀᴏᴜᴘ.**\n\n"
-            f"**ᴄʜᴀɴɴᴇʟ:** {channel_title}\n"
-            f"**ᴄʜᴀɴɴᴇʟ ɪᴅ:** `{channel_id}`"
-        )
-    except Exception as e:
-        await forcesub_collection.delete_one({"chat_id": chat_id})
-        await event.reply("**ᴇʀʀᴏʀ: ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ᴄʜᴀɴɴᴇʟ ɴᴏᴛ ғᴏᴜɴᴅ. ɪᴛ ʜᴀs ʙᴇᴇɴ ᴅɪsᴀʙʟᴇᴅ.**")
+        "• /status - Check current force subscription status\n"
+        "• /audit - Check existing members against the channels\n"
+        "• /audit mute - Also mute members who haven't joined\n"
+        "• /setjoin requests - Check members once when they ask to join\n\n"
+        "**How to use:**\n"
+        "1. Add me to your group as admin\n"
+        "2. Add me to your channel as admin with 'Invite Users' permission\n"
+        "3. Use /join command in your group to set force subscription"
+    )
 
-# Join command to set force subscription
-@app.on(events.NewMessage(pattern=r"[/!\.](join|fsub|forcesub)($| .+)"))
-async def set_forcesub(event):
+# Status command
+@command("status", admin=True)
+async def status_command(event, ctx):
     if not event.is_group:
         return
         
-    chat_id = event.chat_id
-    user_id = event.sender_id
+    chat_id = ctx.chat_id
     
     # Check if user is admin
-    is_admin = False
-    async for admin in app.iter_participants(chat_id, filter=ChannelParticipantAdmin):
-        if admin.id == user_id:
-            is_admin = True
-            break
-    
-    if not (is_admin or user_id == event.chat.creator or user_id == OWNER_ID):
+    if not ctx.is_admin:
         return await event.reply("**ᴏɴʟʏ ɢʀᴏᴜᴘ ᴏᴡɴᴇʀs ᴏʀ sᴜᴅᴏᴇʀs ᴄᴀɴ ᴜsᴇ ᴛʜɪs ᴄᴏᴍᴍᴀɴᴅ.**")
-
-    args = event.pattern_match.group(2).strip()
     
-    if args.lower() in ["off", "disable"]:
-        await forcesub_collection.delete_one({"chat_id": chat_id})
-        return await event.reply("**ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ʜᴀs ʙᴇᴇɴ ᴅɪsᴀʙʟᴇᴅ ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ.**")
-
-    if not args:
-        return await event.reply("**ᴜsᴀɢᴇ: /join <ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ ᴏʀ ɪᴅ> ᴏʀ /join ᴏғғ ᴛᴏ ᴅɪsᴀʙʟᴇ**")
-
-    channel_input = args
-
-    try:
-        channel_info = await bot.get_entity(channel_input)
-        channel_id = channel_info.id
-        channel_title = channel_info.title
-        
-        # Generate invite link
-        from telethon.tl.functions.messages import ExportChatInviteRequest
-        invite_link = await bot(ExportChatInviteRequest(channel_id))
-        channel_link = invite_link.link
-        
-        channel_username = f"{channel_info.username}" if hasattr(channel_info, 'username') and channel_info.username else channel_link
-        
-        # Get members count
-        from telethon.tl.functions.channels import GetFullChannelRequest
-        full_channel = await bot(GetFullChannelRequest(channel=channel_info))
-        channel_members_count = full_channel.full_chat.participants_count
-
-        # Check if bot is admin
-        bot_id = (await bot.get_me()).id
-        bot_is_admin = False
-        
-        try:
-            bot_participant = await bot(GetParticipantRequest(channel=channel_id, participant=bot_id))
-            if isinstance(bot_participant.participant, (ChannelParticipantAdmin, ChannelParticipantCreator)):
-                bot_is_admin = True
-        except UserNotParticipantError:
-            bot_is_admin = False
-
-        if not bot_is_admin:
-            me = await app.get_me()
-            return await event.reply(
-                file="https://graph.org/file/8e1e242d4fec73ab9a8a9.jpg",
-                message=("**🚫 I'ᴍ ɴᴏᴛ ᴀɴ ᴀᴅᴍɪɴ ɪɴ ᴛʜɪs ᴄʜᴀɴɴᴇʟ.**\n\n"
-                         "**➲ ᴘʟᴇᴀsᴇ ᴍᴀᴋᴇ ᴍᴇ ᴀɴ ᴀᴅᴍɪɴ ᴡɪᴛʜ:**\n\n"
-                         "**➥ Iɴᴠɪᴛᴇ Nᴇᴡ Mᴇᴍʙᴇʀs**\n\n"
-                         "🛠️ **Tʜᴇɴ ᴜsᴇ /join <ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ> ᴛᴏ sᴇᴛ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ.**"),
-                buttons=[
-                    [Button.url("๏ ᴀᴅᴅ ᴍᴇ ɪɴ ᴄʜᴀɴɴᴇʟ ๏", f"https://t.me/{me.username}?startchannel=s&admin=invite_users+manage_chat")]
-                ]
-            )
-
-        await forcesub_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {"channel_id": channel_id, "channel_username": channel_username}},
-            upsert=True
-        )
+    forcesub_data = forcesub_configs.get(chat_id)
+    channel_ids = required_channels(forcesub_data)
+    if not channel_ids:
+        return await event.reply("**ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs ɴᴏᴛ ᴇɴᴀʙʟᴇᴅ ɪɴ ᴛʜɪs ɢʀᴏᴜᴘ.**")
 
-        set_by_user = f"@{event.sender.username}" if event.sender.username else event.sender.first_name
+    # Stored health only; channels never checked are queued for the next round
+    titles = {marked_channel_id(ch["id"]): ch.get("title") for ch in forcesub_data.get("channels") or []}
+    unchecked = [channel_id for channel_id in channel_ids if channel_health.get(channel_id) is None]
+    if unchecked:
+        channel_health.schedule(unchecked)
 
-        await event.reply(
-            file="https://graph.org/file/8e1e242d4fec73ab9a8a9.jpg",
-            message=(
-                f"**🎉 ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ sᴇᴛ ᴛᴏ** [{channel_title}]({channel_username}) **ғᴏʀ ᴛʜɪs ɢʀᴏᴜᴘ.**\n\n"
-                f"**🆔 ᴄʜᴀɴɴᴇʟ ɪᴅ:** `{channel_id}`\n"
-                f"**🖇️ ᴄʜᴀɴɴᴇʟ ʟɪɴᴋ:** [ɢᴇᴛ ʟɪɴᴋ]({channel_link})\n"
-                f"**📊 ᴍᴇᴍʙᴇʀ ᴄᴏᴜɴᴛ:** {channel_members_count}\n"
-                f"**👤 sᴇᴛ ʙʏ:** {set_by_user}"
-            ),
-            buttons=[
-                [Button.inline("๏ ᴄʟᴏsᴇ ๏", data="close_force_sub")]
-            ]
-        )
+    lines = []
+    for channel_id in channel_ids:
+        health = channel_health.get(channel_id) or {}
+        title = health.get("title") or titles.get(channel_id) or "Unknown"
+        if not health:
+            state = "⏳ ɴᴏᴛ ᴄʜᴇᴄᴋᴇᴅ ʏᴇᴛ"
+        elif health["ok"]:
+            state = f"✅ ᴏᴋ, {health.get('members') or '?'} ᴍᴇᴍʙᴇʀs"
+        else:
+            state = f"⚠️ {health['error']}"
+        if health:
+            state += f" ({int(time.time() - health['checked_at']) // 60}ᴍ ᴀɢᴏ)"
+        lines.append(f"**ᴄʜᴀɴɴᴇʟ:** {title}\n**ᴄʜᴀɴɴᴇʟ ɪᴅ:** `{channel_id}`\n**sᴛᴀᴛᴜs:** {state}")
 
-    except Exception as e:
-        await event.reply(
-            file="https://graph.org/file/8e1e242d4fec73ab9a8a9.jpg",
-            message=("**🚫 ᴇʀʀᴏʀ ᴏᴄᴄᴜʀʀᴇᴇᴅ!**\n\n"
-                     f"**ᴇʀʀᴏʀ:** `{str(e)}`\n\n"
-                     "**ᴘᴏssɪʙʟᴇ ʀᴇᴀsᴏɴs:**\n"
-                     "• I'ᴍ ɴᴏᴛ ᴀɴ ᴀᴅᴍɪɴ ɪɴ ᴛʜᴇ ᴄʜᴀɴɴᴇʟ\n"
-                     "• Iɴᴠᴀʟɪᴅ ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ/ID\n"
-                     "• Tʜᴇ ᴄʜᴀɴɴᴇʟ ɪs ᴍᴀɴɴᴇᴍ"),
-            buttons=[
-                [Button.inline("๏ ᴛʀʏ ᴀɢᴀɪɴ ๏", data="close_force_sub")]
-            ]
-        )
+    header = "**ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ ɪs ᴄᴜʀʀᴇɴᴛʟʏ ᴇɴᴀʙʟᴇᴅ ɪɴ ᴛʜɪs ɢʀᴏᴜᴘ.**"
+    if forcesub_data.get("degraded"):
+        header += ("\n\n**⚠️ sᴏᴍᴇ ᴄʜᴀɴɴᴇʟs ᴄᴀɴ'ᴛ ʙᴇ ᴄʜᴇᴄᴋᴇᴅ ᴀɴᴅ ᴀʀᴇ sᴋɪᴘᴘᴇᴅ. "
+                   "ᴍᴀᴋᴇ ᴍᴇ ᴀɴ ᴀᴅᴍɪɴ ᴛʜᴇʀᴇ ᴀɢᴀɪɴ ᴏʀ ᴜsᴇ /join ᴛᴏ ʀᴇᴄᴏɴғɪɢᴜʀᴇ.**")
+    await event.reply(header + "\n\n" + "\n\n".join(lines))
 
 # Close and cancel button callbacks
 @app.on(events.CallbackQuery(pattern="close_force_sub"))
+@instrument
 async def close_force_sub(event):
     await event.answer("ᴄʟᴏsᴇᴅ!")
     await event.delete()
 
 @app.on(events.CallbackQuery(pattern="cancel_setjoin"))
+@instrument
 async def cancel_setjoin(event):
-    chat_id = event.chat.id
+    chat_id = event.chat_id
     user_id = event.sender_id
     
     if not await is_admin(chat_id, user_id):
         return await event.answer("Only admins can use this!", alert=True)
     
-    config = await forcesub_collection.find_one({"chat_id": chat_id})
+    config = forcesub_configs.get(chat_id)
     enabled = config.get("enabled", False) if config else False
+    requests = gates_join_requests(config)
     
     await event.edit(
         "**📱 Force Subscription Settings**",
@@ -408,23 +2202,24 @@ async def cancel_setjoin(event):
             [Button.inline("Single Channel", data="set_single")],
             [Button.inline("Multiple Channels", data="set_multiple")],
             [Button.inline("✅ Enable" if not enabled else "❌ Disable", 
-             data="fsub_on" if not enabled else "fsub_off")]
+             data="fsub_on" if not enabled else "fsub_off")],
+            [Button.inline("📨 Check Messages" if requests else "🔐 Check Join Requests",
+             data="set_gate_messages" if requests else "set_gate_requests")]
         ]
     )
 
 # Add new command handler for /setjoin
-@app.on(events.NewMessage(pattern="/setjoin"))
-async def setjoin_command(event):
-    if await check_fsub_handler(event):
-        return
+@command("setjoin", admin=True)
+async def setjoin_command(event, ctx):
     if not event.is_group:
         return await event.reply("**⚠️ This command can only be used in groups!**")
-        
-    chat_id = event.chat_id
-    user_id = event.sender_id
     
-    if not await is_admin(chat_id, user_id):
+    if not ctx.is_admin:
         return await event.reply("**🚫 Only admins can use this command!**")
+
+    gate = ctx.args.lower()
+    if gate in ("requests", "messages"):
+        return await event.reply(await set_join_gate(ctx.chat_id, gate))
     
     await event.reply(
         "**📝 ʜᴏᴡ ᴛᴏ ᴜsᴇ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ**\n\n"
@@ -436,13 +2231,17 @@ async def setjoin_command(event):
         "• /join -100123456789 -100987654321\n\n"
         "**ᴅɪsᴀʙʟᴇ ғᴏʀᴄᴇsᴜʙ:**\n"
         "• /join off\n\n"
+        "**ᴄʜᴇᴄᴋ ᴏɴᴄᴇ ᴘᴇʀ ᴊᴏɪɴ ʀᴇǫᴜᴇsᴛ ɪɴsᴛᴇᴀᴅ ᴏғ ᴘᴇʀ ᴍᴇssᴀɢᴇ:**\n"
+        "• /setjoin requests\n"
+        "• /setjoin messages\n\n"
         "**ɴᴏᴛᴇ:** ᴍᴀᴋᴇ sᴜʀᴇ ɪ'ᴍ ᴀᴅᴍɪɴ ɪɴ ᴀʟʟ ᴄʜᴀɴɴᴇʟs"
     )
 
 @app.on(events.CallbackQuery(pattern=r"set_(single|multiple)"))
+@instrument
 async def setjoin_callback(event):
-    mode = event.pattern_match.group(1)
-    chat_id = event.chat.id
+    mode = event.pattern_match.group(1).decode()
+    chat_id = event.chat_id
     user_id = event.sender_id
     
     # Check if user is admin
@@ -457,11 +2256,7 @@ async def setjoin_callback(event):
         "enabled": False
     }
     
-    await forcesub_collection.update_one(
-        {"chat_id": chat_id},
-        {"$set": config},
-        upsert=True
-    )
+    await forcesub_configs.update(chat_id, config)
     
     if mode == "single":
         msg = ("**✏️ Send channel information:**\n\n"
@@ -485,41 +2280,80 @@ async def setjoin_callback(event):
         ]
     )
 
-# Modify join command to check setjoin first
-@app.on(events.NewMessage(pattern=r"[/!\.](join|fsub|forcesub)($| .+)"))
-async def set_forcesub(event):
+FSUB_BANNER = "https://graph.org/file/8e1e242d4fec73ab9a8a9.jpg"
+
+# The banner is fetched from its URL once; later replies reuse the photo
+# Telegram stored, until its file reference stops being accepted
+class CachedFile:
+    def __init__(self, source):
+        self.source = source
+        self.media = None
+
+    async def reply(self, event, message, buttons=None):
+        if self.media is not None:
+            try:
+                return await event.reply(file=self.media, message=message, buttons=buttons)
+            except (FileReferenceExpiredError, FileReferenceInvalidError):
+                self.media = None
+        sent = await event.reply(file=self.source, message=message, buttons=buttons)
+        self.media = getattr(sent, "photo", None) or getattr(sent, "document", None)
+        return sent
+
+fsub_banner = CachedFile(FSUB_BANNER)
+
+class BotNotAdminError(ValueError):
+    pass
+
+# Resolve a /join argument and make sure the bot is an admin there
+async def validate_fsub_channel(channel, bot_id):
+    channel_entity = await resolver.get(channel)
+    channel_id = channel_entity.id
+    marked = marked_channel_id(channel_id)
+    # A recent healthy check stands in for asking Telegram again
+    health = channel_health.get(marked)
+    if not channel_health.fresh(marked) or not health["ok"]:
+        health = await channel_health.revalidate(marked, bot_id)
+    if health["error"] == "NotAdmin":
+        raise BotNotAdminError(f"I need to be an admin in {channel_entity.title}!")
+    if not health["ok"]:
+        raise BotNotAdminError(f"I'm not even a member of {channel_entity.title}!")
+    return {
+        "id": channel_id,
+        "title": channel_entity.title,
+        "username": channel_entity.username if hasattr(channel_entity, 'username') else None
+    }
+
+# Join command to set force subscription
+@command("join", "fsub", "forcesub", prefixes="/!.", admin=True)
+async def set_forcesub(event, ctx):
     if not event.is_group:
         return await event.reply("**⚠️ This command can only be used in groups!**")
         
-    chat_id = event.chat_id
-    user_id = event.sender_id
+    chat_id = ctx.chat_id
     
-    if not await is_admin(chat_id, user_id):
+    if not ctx.is_admin:
         return await event.reply("**🚫 Only admins can use this command!**")
 
-    args = event.pattern_match.group(2).strip()
+    args = ctx.args
     
     # Handle disable command
     if args.lower() in ["off", "disable"]:
-        await forcesub_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {"enabled": False}}
-        )
+        await forcesub_configs.update(chat_id, {"enabled": False}, upsert=False)
         return await event.reply("**✅ Force subscription has been disabled**")
     
-    # Check if setjoin was configured
-    config = await forcesub_collection.find_one({"chat_id": chat_id})
-    if not config:
-        return await event.reply(
-            "**⚠️ Please configure force subscription first using /setjoin**",
-            buttons=[
-                [Button.inline("Configure Now", data="set_single")],
-                [Button.inline("« Back", data="cancel_setjoin")]
-            ]
-        )
+    config = forcesub_configs.get(chat_id)
     
     # If no arguments provided, show current status
     if not args:
+        if not config:
+            return await event.reply(
+                "**⚠️ Please configure force subscription first using /setjoin**",
+                buttons=[
+                    [Button.inline("Configure Now", data="set_single")],
+                    [Button.inline("« Back", data="cancel_setjoin")]
+                ]
+            )
+
         enabled = config.get("enabled", False)
         mode = config.get("mode", "single")
         channels = config.get("channels", [])
@@ -527,6 +2361,7 @@ async def set_forcesub(event):
         status_text = "**📱 Force Subscription Status**\n\n"
         status_text += f"**Status:** {'Enabled' if enabled else 'Disabled'}\n"
         status_text += f"**Mode:** {mode.title()}\n"
+        status_text += f"**Checks:** {'Join requests' if gates_join_requests(config) else 'Messages'}\n"
         status_text += f"**Channels:** {len(channels)}\n\n"
         
         if channels:
@@ -552,54 +2387,70 @@ async def set_forcesub(event):
         if len(channels) > 4:
             return await event.reply("**⚠️ Maximum 4 channels allowed!**")
             
-        valid_channels = []
-        for channel in channels:
-            try:
-                channel_entity = await bot.get_entity(channel)
-                channel_id = channel_entity.id
-                
-                # Check if bot is admin
-                bot_id = (await bot.get_me()).id
-                try:
-                    participant = await bot(GetParticipantRequest(channel=channel_id, participant=bot_id))
-                    if not isinstance(participant.participant, (ChannelParticipantAdmin, ChannelParticipantCreator)):
-                        return await event.reply(f"**🚫 I need to be an admin in {channel_entity.title}!**")
-                except UserNotParticipantError:
-                    return await event.reply(f"**🚫 I'm not even a member of {channel_entity.title}!**")
-                    
-                valid_channels.append({
-                    "id": channel_id,
-                    "title": channel_entity.title,
-                    "username": channel_entity.username if hasattr(channel_entity, 'username') else None
-                })
-            except Exception as e:
-                return await event.reply(f"**❌ Error with channel {channel}: {str(e)}**")
+        me = await resolver.get_me()
+        results = await fanout(lambda channel: validate_fsub_channel(channel, me.id), channels)
+        if results.failed:
+            errors = "\n".join(f"• `{channel}`: {str(e)}" for channel, e in results.failed)
+            if any(isinstance(e, BotNotAdminError) for _, e in results.failed):
+                return await fsub_banner.reply(
+                    event,
+                    message=("**🚫 I'ᴍ ɴᴏᴛ ᴀɴ ᴀᴅᴍɪɴ ɪɴ ᴛʜɪs ᴄʜᴀɴɴᴇʟ.**\n\n"
+                             f"{errors}\n\n"
+                             "**➲ ᴘʟᴇᴀsᴇ ᴍᴀᴋᴇ ᴍᴇ ᴀɴ ᴀᴅᴍɪɴ ᴡɪᴛʜ:**\n\n"
+                             "**➥ Iɴᴠɪᴛᴇ Nᴇᴡ Mᴇᴍʙᴇʀs**\n\n"
+                             "🛠️ **Tʜᴇɴ ᴜsᴇ /join <ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ> ᴛᴏ sᴇᴛ ғᴏʀᴄᴇ sᴜʙsᴄʀɪᴘᴛɪᴏɴ.**"),
+                    buttons=[
+                        [Button.url("๏ ᴀᴅᴅ ᴍᴇ ɪɴ ᴄʜᴀɴɴᴇʟ ๏", f"https://t.me/{me.username}?startchannel=s&admin=invite_users+manage_chat")]
+                    ]
+                )
+            return await event.reply(f"**❌ Error with channel(s):**\n\n{errors}")
+        valid_channels = [channel for _, channel in results.ok]
         
         # Update database
-        await forcesub_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {
-                "channels": valid_channels,
-                "enabled": True,
-                "mode": "multiple" if len(valid_channels) > 1 else "single"
-            }},
-            upsert=True
-        )
+        await forcesub_configs.update(chat_id, {
+            "channels": valid_channels,
+            "enabled": True,
+            "mode": "multiple" if len(valid_channels) > 1 else "single"
+        })
+        member_index.schedule_refresh(marked_channel_id(ch["id"]) for ch in valid_channels)
+
+        set_by_user = f"@{ctx.sender.username}" if ctx.sender.username else ctx.sender.first_name
+        channel_text = "\n".join(f"• {ch['title']} [`{ch['id']}`]" for ch in valid_channels)
         
-        await event.reply(
-            f"**✅ Successfully configured {len(valid_channels)} channel(s)!**\n\n"
-            "**Force subscription is now enabled.**",
-            buttons=[[Button.inline("« Back", data="cancel_setjoin")]]
+        await fsub_banner.reply(
+            event,
+            message=(
+                f"**✅ Successfully configured {len(valid_channels)} channel(s)!**\n\n"
+                f"{channel_text}\n\n"
+                f"**👤 sᴇᴛ ʙʏ:** {set_by_user}\n"
+                "**Force subscription is now enabled.**"
+            ),
+            buttons=[
+                [Button.inline("« Back", data="cancel_setjoin")],
+                [Button.inline("๏ ᴄʟᴏsᴇ ๏", data="close_force_sub")]
+            ]
         )
         
     except Exception as e:
-        await event.reply(f"**❌ Error: {str(e)}**")
+        await fsub_banner.reply(
+            event,
+            message=("**🚫 ᴇʀʀᴏʀ ᴏᴄᴄᴜʀʀᴇᴇᴅ!**\n\n"
+                     f"**ᴇʀʀᴏʀ:** `{str(e)}`\n\n"
+                     "**ᴘᴏssɪʙʟᴇ ʀᴇᴀsᴏɴs:**\n"
+                     "• I'ᴍ ɴᴏᴛ ᴀɴ ᴀᴅᴍɪɴ ɪɴ ᴛʜᴇ ᴄʜᴀɴɴᴇʟ\n"
+                     "• Iɴᴠᴀʟɪᴅ ᴄʜᴀɴɴᴇʟ ᴜsᴇʀɴᴀᴍᴇ/ID\n"
+                     "• Tʜᴇ ᴄʜᴀɴɴᴇʟ ɪs ᴍᴀɴɴᴇᴍ"),
+            buttons=[
+                [Button.inline("๏ ᴛʀʏ ᴀɢᴀɪɴ ๏", data="close_force_sub")]
+            ]
+        )
 
 # Add callback for join enable/disable
 @app.on(events.CallbackQuery(pattern=r"fsub_(on|off)"))
+@instrument
 async def join_callback(event):
-    status = event.pattern_match.group(1)
-    chat_id = event.chat.id
+    status = event.pattern_match.group(1).decode()
+    chat_id = event.chat_id
     user_id = event.sender_id
     
     # Check if user is admin
@@ -607,10 +2458,7 @@ async def join_callback(event):
         return await event.answer("Only admins can change force subscription status!", alert=True)
     
     if status == "off":
-        await forcesub_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {"enabled": False}}
-        )
+        await forcesub_configs.update(chat_id, {"enabled": False}, upsert=False)
         await event.edit(
             "**❌ Force subscription has been disabled**",
             buttons=[
@@ -620,7 +2468,7 @@ async def join_callback(event):
         )
         
     else:
-        config = await forcesub_collection.find_one({"chat_id": chat_id})
+        config = forcesub_configs.get(chat_id)
         if not config or not config.get("channels"):
             return await event.edit(
                 "**⚠️ No channels configured. Use /setjoin first!**",
@@ -630,10 +2478,7 @@ async def join_callback(event):
                 ]
             )
             
-        await forcesub_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {"enabled": True}}
-        )
+        await forcesub_configs.update(chat_id, {"enabled": True}, upsert=False)
         
         channels = config.get("channels", [])
         channel_text = "\n".join([f"• {ch.get('title', 'Unknown')} [`{ch.get('id')}`]" for ch in channels])
@@ -647,7 +2492,778 @@ async def join_callback(event):
             ]
         )
 
-# Modify check_forcesub to handle multiple channels
+# Group enforcement. Config and verdicts come from memory, so a member who is
+# known to be subscribed costs no RPC at all. Unknown verdicts are checked
+# together, with a per-chat cap on concurrent checks. Admins are skipped
+# before any check is made.
+FSUB_ACTION = os.getenv("FSUB_ACTION", "delete")  # delete or mute
+FSUB_MUTE_MINUTES = int(os.getenv("FSUB_MUTE_MINUTES", "60"))
+ENFORCE_CHAT_CONCURRENCY = int(os.getenv("ENFORCE_CHAT_CONCURRENCY", "4"))
+
+# A chat's semaphore lives only while checks for it are running, so chats
+# the bot has gone quiet in hold no memory
+class ChatLimits:
+    def __init__(self, limit):
+        self.limit = limit
+        self._chats = {}  # chat_id -> [semaphore, holders and waiters]
+
+    @asynccontextmanager
+    async def hold(self, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Semaphore(self.limit), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    def __len__(self):
+        return len(self._chats)
+
+chat_check_limits = ChatLimits(ENFORCE_CHAT_CONCURRENCY)
+
+# Configs store channel ids as returned by entity.id; Telegram requests need
+# the marked -100... form
+def marked_channel_id(channel_id):
+    channel_id = int(channel_id)
+    return utils.get_peer_id(PeerChannel(channel_id)) if channel_id > 0 else channel_id
+
+# Channels a group requires. Covers both the channels list written by /join
+# and the older single channel_id documents.
+def required_channels(config):
+    if not config or not config.get("enabled", "channel_id" in config):
+        return []
+    return config_channels(config)
+
+# Every channel a config names, enabled or not
+def config_channels(config):
+    if not config:
+        return []
+    if config.get("channels"):
+        return [marked_channel_id(channel["id"]) for channel in config["channels"]]
+    if config.get("channel_id"):
+        return [marked_channel_id(config["channel_id"])]
+    return []
+
+async def channel_buttons(config, channel_ids):
+    legacy = config.get("channel_username")
+    if not config.get("channels") and legacy:
+        # Older single channel configs store a username or an invite link
+        url = legacy if legacy.startswith("https://") else f"https://t.me/{legacy}"
+        return [[Button.url("Join Channel", url)]]
+
+    channels = {marked_channel_id(channel["id"]): channel for channel in config.get("channels") or []}
+    buttons = []
+    for channel_id in channel_ids:
+        channel = channels.get(channel_id, {})
+        title = channel.get("title") or "Channel"
+        if channel.get("username"):
+            buttons.append([Button.url(f"Join {title}", f"https://t.me/{channel['username']}")])
+            continue
+        try:
+            link = await invite_links.get_link(channel_id)
+            buttons.append([Button.url(f"Join {title}", link)])
+        except Exception as e:
+            logger.warning(f"No invite link for {channel_id}: {e}")
+    return buttons
+
+# Channel health. A background task revalidates every configured channel in
+# rate-limited batches: title, username, member count and whether the bot is
+# still an admin that can invite. Results are stored per channel, configs
+# with broken channels are marked degraded instead of deleted, and commands
+# read the stored state instead of asking Telegram.
+CHANNEL_HEALTH_INTERVAL = int(os.getenv("CHANNEL_HEALTH_INTERVAL", "3600"))
+CHANNEL_HEALTH_POLL = 300
+CHANNEL_HEALTH_BATCH = 20
+CHANNEL_HEALTH_RATE = float(os.getenv("CHANNEL_HEALTH_RATE", "1"))  # channels per second
+
+# Errors meaning the bot has lost the channel, as opposed to a passing failure
+CHANNEL_BROKEN_ERRORS = (
+    ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError, ChatIdInvalidError,
+    ChatAdminRequiredError, UserNotParticipantError
+)
+
+channel_health_bucket = TokenBucket(CHANNEL_HEALTH_RATE)
+CHANNEL_HEALTH_PROJECTION = {
+    "_id": 1, "title": 1, "username": 1, "members": 1, "bot_admin": 1, "can_invite": 1,
+    "ok": 1, "error": 1, "checked_at": 1
+}
+
+class ChannelHealthStore:
+    def __init__(self, collection, interval):
+        self.collection = collection
+        self.interval = interval
+        self._health = {}
+        self._checking = set()
+        self._pending = {}
+
+    async def load(self):
+        async for doc in self.collection.find({}, CHANNEL_HEALTH_PROJECTION):
+            self._health[doc.pop("_id")] = doc
+        logger.info(f"Loaded health of {len(self._health)} channels")
+
+    def get(self, channel_id):
+        return self._health.get(channel_id)
+
+    def fresh(self, channel_id):
+        health = self._health.get(channel_id)
+        return health is not None and time.time() - health["checked_at"] < self.interval
+
+    # Broken channels cannot be checked, so enforcement leaves them out
+    def usable(self, channel_id):
+        health = self._health.get(channel_id)
+        return health is None or health["ok"]
+
+    def broken(self):
+        return sum(1 for health in self._health.values() if not health["ok"])
+
+    # Raises on errors that say nothing about the channel (timeouts, FloodWait)
+    async def check(self, channel_id, me_id):
+        health = dict(self._health.get(channel_id) or {}, checked_at=time.time(), error=None)
+        try:
+            full = await bot(GetFullChannelRequest(channel_id))
+            channel = full.chats[0]
+            health.update(
+                title=channel.title,
+                username=getattr(channel, "username", None),
+                members=full.full_chat.participants_count
+            )
+            participant = (await bot(GetParticipantRequest(channel=channel_id, participant=me_id))).participant
+        except CHANNEL_BROKEN_ERRORS as e:
+            health.update(ok=False, bot_admin=False, can_invite=False, error=type(e).__name__)
+            return health
+
+        creator = isinstance(participant, ChannelParticipantCreator)
+        admin = creator or isinstance(participant, ChannelParticipantAdmin)
+        rights = getattr(participant, "admin_rights", None)
+        health.update(ok=admin, bot_admin=admin, can_invite=creator or bool(admin and rights and rights.invite_users))
+        if not admin:
+            health["error"] = "NotAdmin"
+        return health
+
+    async def save(self, results):
+        for channel_id, health in results:
+            self._health[channel_id] = health
+            if not health["ok"]:
+                await invite_links.invalidate(channel_id)
+        await self.collection.bulk_write(
+            [UpdateOne({"_id": channel_id}, {"$set": health}, upsert=True) for channel_id, health in results],
+            ordered=False
+        )
+
+    # Check one channel now and store the result. Concurrent callers for the
+    # same channel share a single check.
+    async def revalidate(self, channel_id, me_id):
+        future = self._pending.get(channel_id)
+        if future is None:
+            future = asyncio.ensure_future(self._revalidate(channel_id, me_id))
+            self._pending[channel_id] = future
+            future.add_done_callback(lambda _: self._pending.pop(channel_id, None))
+        return await asyncio.shield(future)
+
+    async def _revalidate(self, channel_id, me_id):
+        health = await self.check(channel_id, me_id)
+        await self.save([(channel_id, health)])
+        return health
+
+    async def _check_limited(self, channel_id, me_id):
+        await channel_health_bucket.acquire()
+        return await self.check(channel_id, me_id)
+
+    async def refresh(self, channel_ids):
+        channel_ids = [c for c in channel_ids if c not in self._checking]
+        if not channel_ids:
+            return
+        self._checking.update(channel_ids)
+        try:
+            me = await resolver.get_me()
+            with rpc_lane(LANE_BACKGROUND):
+                for start in range(0, len(channel_ids), CHANNEL_HEALTH_BATCH):
+                    batch = channel_ids[start:start + CHANNEL_HEALTH_BATCH]
+                    results = await fanout(lambda channel_id: self._check_limited(channel_id, me.id), batch)
+                    for channel_id, error in results.failed:
+                        logger.warning(f"Health check of {channel_id} failed, keeping the last state: {error}")
+                    if results.ok:
+                        await self.save(results.ok)
+                        await fanout(invite_links.check, [c for c, health in results.ok if health["ok"]])
+        finally:
+            self._checking.difference_update(channel_ids)
+        await self.apply_to_configs()
+
+    def schedule(self, channel_ids):
+        return asyncio.ensure_future(self.refresh(list(channel_ids)))
+
+    # Flag configs with broken channels and carry renamed titles and
+    # usernames over into the stored channel list
+    async def apply_to_configs(self):
+        for chat_id, config in list(forcesub_configs.items()):
+            fields = {}
+            broken = [c for c in config_channels(config) if not self.usable(c)]
+            if broken != (config.get("degraded") or []):
+                fields["degraded"] = broken
+                if broken:
+                    logger.warning(f"Force subscription in {chat_id} is degraded, broken channels: {broken}")
+
+            channels, renamed = [], False
+            for channel in config.get("channels") or []:
+                health = self._health.get(marked_channel_id(channel["id"]))
+                if health and health.get("title") and (health["title"], health.get("username")) != (
+                        channel.get("title"), channel.get("username")):
+                    channel = dict(channel, title=health["title"], username=health.get("username"))
+                    renamed = True
+                channels.append(channel)
+            if renamed:
+                fields["channels"] = channels
+
+            if fields:
+                try:
+                    await forcesub_configs.update(chat_id, fields, upsert=False)
+                except Exception as e:
+                    logger.warning(f"Could not update config of {chat_id}: {e}")
+
+    async def run(self):
+        while True:
+            channel_ids = set(FSUB_IDS)
+            for _, config in forcesub_configs.items():
+                channel_ids.update(config_channels(config))
+            stale = [channel_id for channel_id in channel_ids if not self.fresh(channel_id)]
+            if stale:
+                try:
+                    await self.refresh(stale)
+                except Exception as e:
+                    logger.error(f"Channel health refresh failed: {e}")
+            await asyncio.sleep(CHANNEL_HEALTH_POLL)
+
+channel_health = ChannelHealthStore(channel_health_collection, CHANNEL_HEALTH_INTERVAL)
+
+# Required channels the bot can still check
+def checkable_channels(config):
+    return [channel_id for channel_id in required_channels(config) if channel_health.usable(channel_id)]
+
+async def enforce_forcesub(event, config, not_joined):
+    chat_id = event.chat_id
+    user_id = event.sender_id
+    action = config.get("action", FSUB_ACTION)
+
+    try:
+        await event.delete()
+    except Exception as e:
+        logger.warning(f"Could not delete message in {chat_id}: {e}")
+
+    if action == "mute":
+        try:
+            await bot.edit_permissions(
+                chat_id, user_id, timedelta(minutes=FSUB_MUTE_MINUTES), send_messages=False
+            )
+        except Exception as e:
+            logger.warning(f"Could not mute {user_id} in {chat_id}: {e}")
+
+    if prompts.cooling_down(chat_id, user_id):
+        return
+    buttons = await channel_buttons(config, not_joined)
+    buttons.append([Button.inline("✅ ɪ'ᴠᴇ ᴊᴏɪɴᴇᴅ", data=f"fsub_verify_{user_id}")])
+    sender = await event.get_sender()
+    name = getattr(sender, "first_name", None) or "User"
+    await prompts.show(
+        chat_id, user_id,
+        f"**👋 [{name}](tg://user?id={user_id}), ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴏᴜʀ ᴄʜᴀɴɴᴇʟ(s) ᴛᴏ ᴄʜᴀᴛ ɪɴ ᴛʜɪs ɢʀᴏᴜᴘ!**",
+        buttons
+    )
+
+# Returns True when the message was blocked
 async def check_forcesub(event):
-    pass
-    # ... existing code ...
+    user_id = event.sender_id
+    # Anonymous admins post as the group and linked channels as the channel;
+    # neither can join anything, so only users are checked
+    if not event.is_group or not user_id or user_id < 0 or user_id == OWNER_ID:
+        return False
+
+    config = forcesub_configs.get(event.chat_id)
+    channels = checkable_channels(config)
+    if not channels or gates_join_requests(config):
+        return False
+
+    verdicts = [verdict_cache.get(user_id, channel_id) for channel_id in channels]
+    not_joined = [c for c, joined in zip(channels, verdicts) if joined is False]
+    unknown = [c for c, joined in zip(channels, verdicts) if joined is None]
+    if not not_joined and not unknown:
+        return False
+    if await is_admin(event.chat_id, user_id):
+        return False
+    if unknown:
+        async with chat_check_limits.hold(event.chat_id):
+            checks = await fanout(lambda channel_id: fetch_membership(user_id, channel_id), unknown)
+        for channel_id, error in checks.failed:
+            logger.warning(f"Membership check failed for {user_id} in {channel_id}: {error}")
+        not_joined += [channel_id for channel_id, joined in checks.ok if not joined]
+
+    if not not_joined:
+        return False
+
+    await enforce_forcesub(event, config, not_joined)
+    return True
+
+@app.on(events.NewMessage(incoming=True, func=lambda e: e.is_group))
+@instrument
+async def forcesub_group_handler(event):
+    with rpc_lane(LANE_ENFORCEMENT):
+        await check_forcesub(event)
+
+# Recheck a muted or prompted member once they say they have joined
+@app.on(events.CallbackQuery(pattern=r"fsub_verify_(\d+)"))
+@instrument
+async def fsub_verify_callback(event):
+    user_id = int(event.pattern_match.group(1))
+    if event.sender_id != user_id:
+        return await event.answer("ᴛʜɪs ʙᴜᴛᴛᴏɴ ɪs ɴᴏᴛ ғᴏʀ ʏᴏᴜ!", alert=True)
+
+    config = forcesub_configs.get(event.chat_id)
+    if not await recheck_membership(event, user_id, checkable_channels(config)):
+        return
+
+    if config and config.get("action", FSUB_ACTION) == "mute":
+        try:
+            await bot.edit_permissions(event.chat_id, user_id, send_messages=True)
+        except Exception as e:
+            logger.warning(f"Could not unmute {user_id} in {event.chat_id}: {e}")
+    await event.answer("✅ ᴛʜᴀɴᴋs ғᴏʀ ᴊᴏɪɴɪɴɢ! ʏᴏᴜ ᴄᴀɴ ɴᴏᴡ ᴄʜᴀᴛ.", alert=True)
+    await event.delete()
+
+# Join request gating. Groups in "requests" mode let new members in through
+# Telegram join requests. Each request is checked against the required
+# channels once and approved or declined, and those groups skip the
+# per-message check. Pending requests are kept in Mongo until handled so a
+# restart picks them up again.
+JOIN_REQUEST_BATCH = int(os.getenv("JOIN_REQUEST_BATCH", "50"))
+JOIN_REQUEST_RATE = float(os.getenv("JOIN_REQUEST_RATE", "5"))  # approvals and declines per second
+JOIN_REQUEST_RETRIES = 3
+
+join_request_bucket = TokenBucket(JOIN_REQUEST_RATE)
+JOIN_REQUEST_PROJECTION = {"_id": 1, "chat_id": 1, "user_id": 1, "requested_at": 1, "attempts": 1}
+
+def gates_join_requests(config):
+    return bool(config) and config.get("gate") == "requests"
+
+class JoinRequestQueue:
+    def __init__(self, collection):
+        self.collection = collection
+        self._pending = OrderedDict()
+        self._wake = asyncio.Event()
+        self.outcomes = defaultdict(int)
+
+    async def load(self):
+        async for doc in self.collection.find({}, JOIN_REQUEST_PROJECTION).sort("requested_at", 1):
+            self._pending[doc["_id"]] = doc
+        logger.info(f"Loaded {len(self._pending)} pending join requests")
+        if self._pending:
+            self._wake.set()
+
+    async def add(self, chat_id, user_id):
+        key = f"{chat_id}:{user_id}"
+        if key in self._pending:
+            return
+        doc = {"chat_id": chat_id, "user_id": user_id, "requested_at": datetime.utcnow(), "attempts": 0}
+        self._pending[key] = dict(doc, _id=key)
+        self._wake.set()
+        await self.collection.update_one({"_id": key}, {"$setOnInsert": doc}, upsert=True)
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def notify(self, config, user_id, not_joined):
+        buttons = await channel_buttons(config, not_joined)
+        try:
+            await bot.send_message(
+                user_id,
+                "**⚠️ ʏᴏᴜʀ ᴊᴏɪɴ ʀᴇǫᴜᴇsᴛ ᴡᴀs ᴅᴇᴄʟɪɴᴇᴅ!**\n\n"
+                "**ᴊᴏɪɴ ᴛʜᴇ ᴄʜᴀɴɴᴇʟ(s) ʙᴇʟᴏᴡ, ᴛʜᴇɴ sᴇɴᴅ ᴀ ɴᴇᴡ ʀᴇǫᴜᴇsᴛ.**",
+                buttons=buttons or None
+            )
+        except Exception as e:
+            logger.debug(f"Could not tell {user_id} about the declined request: {e}")
+
+    # Requests of groups that left "requests" mode are left to their admins
+    async def decide(self, doc):
+        chat_id, user_id = doc["chat_id"], doc["user_id"]
+        config = forcesub_configs.get(chat_id)
+        channels = checkable_channels(config)
+        if not channels or not gates_join_requests(config):
+            return "skipped"
+
+        verdict_cache.invalidate(user_id, channels)
+        checks = await fanout(lambda channel_id: fetch_membership(user_id, channel_id, fresh=True), channels)
+        if checks.failed:
+            raise checks.failed[0][1]
+        not_joined = [channel_id for channel_id, joined in checks.ok if not joined]
+
+        await join_request_bucket.acquire()
+        try:
+            await bot(HideChatJoinRequestRequest(chat_id, user_id, approved=not not_joined))
+        except (HideRequesterMissingError, UserAlreadyParticipantError):
+            return "gone"
+        if not_joined:
+            await self.notify(config, user_id, not_joined)
+            return "declined"
+        return "approved"
+
+    async def process(self, batch):
+        results = await fanout(self.decide, batch)
+        done = [doc["_id"] for doc, _ in results.ok]
+        for doc, error in results.failed:
+            doc["attempts"] += 1
+            if doc["attempts"] >= JOIN_REQUEST_RETRIES:
+                logger.warning(f"Dropping join request of {doc['user_id']} in {doc['chat_id']}: {error}")
+                done.append(doc["_id"])
+            else:
+                self._pending.move_to_end(doc["_id"])
+        for key in done:
+            self._pending.pop(key, None)
+        if done:
+            await self.collection.delete_many({"_id": {"$in": done}})
+        for _, outcome in results.ok:
+            self.outcomes[outcome] += 1
+        return results
+
+    async def run(self):
+        with rpc_lane(LANE_ENFORCEMENT):
+            while True:
+                await self._wake.wait()
+                self._wake.clear()
+                while self._pending:
+                    batch = list(itertools.islice(self._pending.values(), JOIN_REQUEST_BATCH))
+                    try:
+                        results = await self.process(batch)
+                    except Exception as e:
+                        logger.error(f"Join request batch failed: {e}")
+                        results = None
+                    if results is None or results.failed:
+                        await asyncio.sleep(5)
+
+join_requests = JoinRequestQueue(join_requests_collection)
+
+@app.on(events.Raw(UpdateBotChatInviteRequester))
+@instrument
+async def join_request_update(update):
+    chat_id = utils.get_peer_id(update.peer)
+    if gates_join_requests(forcesub_configs.get(chat_id)):
+        await join_requests.add(chat_id, update.user_id)
+
+# Switch a group between per-message checks and join request checks. Public
+# groups get "approve new members" turned on for them; private groups need an
+# invite link that requires approval.
+async def set_join_gate(chat_id, gate):
+    config = forcesub_configs.get(chat_id)
+    if not required_channels(config):
+        return "**⚠️ Please configure force subscription first using /join**"
+
+    if gate == "requests":
+        toggled = False
+        try:
+            await bot(ToggleJoinRequestRequest(chat_id, True))
+            toggled = True
+        except Exception as e:
+            logger.info(f"Could not turn on join requests in {chat_id}: {e}")
+        await forcesub_configs.update(chat_id, {"gate": "requests", "gate_toggled": toggled}, upsert=False)
+        return (
+            "**✅ ɴᴇᴡ ᴍᴇᴍʙᴇʀs ᴀʀᴇ ɴᴏᴡ ᴄʜᴇᴄᴋᴇᴅ ᴡʜᴇɴ ᴛʜᴇʏ ᴀsᴋ ᴛᴏ ᴊᴏɪɴ**\n\n"
+            + ("**ᴀᴘᴘʀᴏᴠᴀʟ ᴏғ ɴᴇᴡ ᴍᴇᴍʙᴇʀs ʜᴀs ʙᴇᴇɴ ᴛᴜʀɴᴇᴅ ᴏɴ.**" if toggled else
+               "**ᴜsᴇ ᴀɴ ɪɴᴠɪᴛᴇ ʟɪɴᴋ ᴡɪᴛʜ \"ʀᴇǫᴜᴇsᴛ ᴀᴅᴍɪɴ ᴀᴘᴘʀᴏᴠᴀʟ\" ᴛᴜʀɴᴇᴅ ᴏɴ.**")
+        )
+
+    if config.get("gate_toggled"):
+        try:
+            await bot(ToggleJoinRequestRequest(chat_id, False))
+        except Exception as e:
+            logger.info(f"Could not turn off join requests in {chat_id}: {e}")
+    await forcesub_configs.update(chat_id, {"gate": "messages", "gate_toggled": False}, upsert=False)
+    return "**✅ ᴍᴇssᴀɢᴇs ᴀʀᴇ ɴᴏᴡ ᴄʜᴇᴄᴋᴇᴅ ᴀɢᴀɪɴ**"
+
+@app.on(events.CallbackQuery(pattern=r"set_gate_(requests|messages)"))
+@instrument
+async def set_gate_callback(event):
+    if not await is_admin(event.chat_id, event.sender_id):
+        return await event.answer("Only admins can use this!", alert=True)
+    text = await set_join_gate(event.chat_id, event.pattern_match.group(1).decode())
+    await event.edit(text, buttons=[[Button.inline("« Back", data="cancel_setjoin")]])
+
+# Audit an existing group against its required channels. Participants are
+# streamed in batches, checked through the member snapshots where possible,
+# and optionally muted under a separate rate budget. Runs as a background
+# task per chat so other handlers are never blocked.
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "200"))
+AUDIT_CHECK_CONCURRENCY = int(os.getenv("AUDIT_CHECK_CONCURRENCY", "4"))
+AUDIT_RESTRICT_RATE = float(os.getenv("AUDIT_RESTRICT_RATE", "3"))  # mutes per second
+AUDIT_PROGRESS_INTERVAL = 15
+AUDIT_REPORT_LIMIT = 20
+
+audit_bucket = TokenBucket(AUDIT_RESTRICT_RATE)
+audit_jobs = {}
+
+class Audit:
+    def __init__(self, chat_id, channels, restrict, progress):
+        self.chat_id = chat_id
+        self.channels = channels
+        self.restrict = restrict
+        self.progress = progress
+        self.scanned = 0
+        self.unchecked = 0
+        self.restricted = 0
+        self.non_members = []
+        self.last_progress = 0
+
+    async def check_batch(self, users):
+        admins = await admin_cache.get(self.chat_id)
+        users = [user for user in users if user.id not in admins and user.id != OWNER_ID]
+        pairs = [(user.id, channel_id) for user in users for channel_id in self.channels]
+        checks = await fanout(lambda pair: fetch_membership(*pair), pairs, AUDIT_CHECK_CONCURRENCY)
+        missing = {user_id for (user_id, _), joined in checks.ok if not joined}
+        failed = {user_id for (user_id, _), _ in checks.failed} - missing
+        self.unchecked += len(failed)
+
+        for user in users:
+            if user.id not in missing:
+                continue
+            self.non_members.append(user)
+            if self.restrict:
+                await self.mute(user.id)
+
+    async def mute(self, user_id):
+        await audit_bucket.acquire()
+        try:
+            await bot.edit_permissions(self.chat_id, user_id, send_messages=False)
+            self.restricted += 1
+            await audit_mutes_collection.update_one(
+                {"_id": audit_mute_key(self.chat_id, user_id)},
+                {"$set": {"muted_at": datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Audit could not mute {user_id} in {self.chat_id}: {e}")
+
+    def text(self, final):
+        title = "🔍 Audit Completed" if final else "🔍 Audit In Progress"
+        text = (
+            f"**{title}**\n\n"
+            f"**Scanned:** {self.scanned}\n"
+            f"**Not Subscribed:** {len(self.non_members)}\n"
+            f"**Unchecked:** {self.unchecked}"
+        )
+        if self.restrict:
+            text += f"\n**Muted:** {self.restricted}"
+        if final and self.non_members:
+            mentions = "\n".join(
+                f"• [{user.first_name or user.id}](tg://user?id={user.id})"
+                for user in self.non_members[:AUDIT_REPORT_LIMIT]
+            )
+            more = len(self.non_members) - AUDIT_REPORT_LIMIT
+            text += f"\n\n**Not Subscribed:**\n{mentions}"
+            if more > 0:
+                text += f"\n...and {more} more"
+        return text
+
+    async def report(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_progress < AUDIT_PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        buttons = None
+        if final and self.restrict and self.restricted:
+            buttons = [[Button.inline("✅ ɪ'ᴠᴇ ᴊᴏɪɴᴇᴅ", data="fsub_unmute")]]
+        try:
+            await self.progress.edit(self.text(final), buttons=buttons)
+        except MessageNotModifiedError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not update audit progress: {e}")
+
+    async def run(self):
+        batch = []
+        async for user in bot.iter_participants(self.chat_id):
+            if user.bot or user.deleted:
+                continue
+            batch.append(user)
+            if len(batch) >= AUDIT_BATCH_SIZE:
+                await self.check_batch(batch)
+                self.scanned += len(batch)
+                batch = []
+                await self.report()
+        if batch:
+            await self.check_batch(batch)
+            self.scanned += len(batch)
+        await self.report(final=True)
+
+# Members an audit muted, so the report's button only lifts those mutes
+def audit_mute_key(chat_id, user_id):
+    return f"{chat_id}:{user_id}"
+
+def start_audit(audit):
+    async def run():
+        try:
+            with rpc_lane(LANE_BACKGROUND):
+                await audit.run()
+        except Exception as e:
+            logger.error(f"Audit of {audit.chat_id} stopped: {e}")
+            try:
+                await audit.progress.edit(f"**❌ Audit failed:** `{str(e)}`")
+            except Exception:
+                pass
+        finally:
+            audit_jobs.pop(audit.chat_id, None)
+    audit_jobs[audit.chat_id] = asyncio.ensure_future(run())
+
+# Audit command
+@command("audit", admin=True)
+async def audit_command(event, ctx):
+    if not event.is_group:
+        return await event.reply("**⚠️ This command can only be used in groups!**")
+
+    if not ctx.is_admin:
+        return await event.reply("**🚫 Only admins can use this command!**")
+
+    channels = checkable_channels(forcesub_configs.get(ctx.chat_id))
+    if not channels:
+        return await event.reply("**⚠️ Force subscription is not enabled in this group!**")
+
+    if ctx.chat_id in audit_jobs:
+        return await event.reply("**⚠️ An audit is already running in this group!**")
+
+    restrict = ctx.args.lower() in ("mute", "restrict")
+    progress = await event.reply("**🔍 Audit Started**")
+    start_audit(Audit(ctx.chat_id, channels, restrict, progress))
+
+# Members muted by an audit unmute themselves from the report once they join
+@app.on(events.CallbackQuery(pattern="fsub_unmute"))
+@instrument
+async def fsub_unmute_callback(event):
+    user_id = event.sender_id
+    key = audit_mute_key(event.chat_id, user_id)
+    if not await audit_mutes_collection.find_one({"_id": key}, {"_id": 1}):
+        return await event.answer("⚠️ ᴛʜɪs ʙᴜᴛᴛᴏɴ ɪs ᴏɴʟʏ ғᴏʀ ᴍᴇᴍʙᴇʀs ᴍᴜᴛᴇᴅ ʙʏ ᴛʜᴇ ᴀᴜᴅɪᴛ.", alert=True)
+    if not await recheck_membership(event, user_id, checkable_channels(forcesub_configs.get(event.chat_id))):
+        return
+    try:
+        await bot.edit_permissions(event.chat_id, user_id, send_messages=True)
+    except Exception as e:
+        logger.warning(f"Could not unmute {user_id} in {event.chat_id}: {e}")
+        return await event.answer("❌ ᴄᴏᴜʟᴅ ɴᴏᴛ ᴜɴᴍᴜᴛᴇ ʏᴏᴜ, ᴀsᴋ ᴀɴ ᴀᴅᴍɪɴ.", alert=True)
+    await audit_mutes_collection.delete_one({"_id": key})
+    await event.answer("✅ ᴛʜᴀɴᴋs ғᴏʀ ᴊᴏɪɴɪɴɢ! ʏᴏᴜ ᴄᴀɴ ɴᴏᴡ ᴄʜᴀᴛ.", alert=True)
+
+# Gauges read on every render
+def cache_ratios():
+    values = {}
+    for name, cache in (("verdict", verdict_cache), ("entity", resolver), ("admin", admin_cache)):
+        total = cache.hits + cache.misses
+        values[(("cache", name),)] = cache.hits / total if total else 0.0
+    return values
+
+metrics.gauge("cache_hit_ratio", cache_ratios)
+metrics.gauge("rpc_queue_depth", lambda: {(("lane", lane),): n for lane, n in zip(LANE_NAMES, rpc_gateway.queued)})
+metrics.gauge("rpc_in_flight", lambda: {(("lane", lane),): n for lane, n in zip(LANE_NAMES, rpc_gateway.in_flight)})
+metrics.gauge("rpc_flood_waits_total", lambda: {(("method", m),): n for m, n in rpc_gateway.flood_waits.items()})
+metrics.gauge("event_loop_lag_seconds", lambda: {(): loop_lag[0]})
+metrics.gauge("tracked_rate_limit_users", lambda: {(): len(rate_limiter)})
+metrics.gauge("join_requests_pending", lambda: {(): len(join_requests)})
+metrics.gauge("broken_channels", lambda: {(): channel_health.broken()})
+metrics.gauge("mongo_breaker_open", lambda: {(): int(not mongo_breaker.closed)})
+metrics.gauge("mongo_journal_size", lambda: {(): len(mongo_breaker.journal)})
+metrics.gauge("mongo_journal_dropped_total", lambda: {(): mongo_breaker.dropped})
+metrics.gauge("join_prompts_total", lambda: {(("outcome", o),): n for o, n in prompts.counts.items()})
+metrics.gauge("join_requests_total", lambda: {(("outcome", o),): n for o, n in join_requests.outcomes.items()})
+
+# Event loop lag: how late a short sleep wakes up
+LOOP_LAG_INTERVAL = 0.5
+loop_lag = [0.0]
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag[0] = max(0.0, loop.time() - start - LOOP_LAG_INTERVAL)
+        metrics.observe("event_loop_lag_seconds_hist", {}, loop_lag[0])
+
+# Prometheus text endpoint; anything sent to it gets the current metrics
+async def serve_metrics(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        body = metrics.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+def latency_lines(name, label, limit=10):
+    series = sorted(metrics.series(name), key=lambda item: -item[1].count)[:limit]
+    return [
+        f"• `{labels.get(label, '-')}`: {h.count} calls, avg {h.sum / h.count * 1000:.0f}ms, "
+        f"p50 ≤{h.quantile(0.5) * 1000:.0f}ms, p99 ≤{h.quantile(0.99) * 1000:.0f}ms"
+        for labels, h in series if h.count
+    ]
+
+# Metrics command
+@command("metrics", owner=True)
+async def metrics_command(event, ctx):
+    ratios = ", ".join(f"{dict(k)['cache']} {v:.0%}" for k, v in cache_ratios().items())
+    queues = ", ".join(f"{lane} {n}" for lane, n in zip(LANE_NAMES, rpc_gateway.queued))
+    sections = [
+        "**📈 Bot Metrics**",
+        "**Handlers:**\n" + "\n".join(latency_lines("handler_latency_seconds", "handler")),
+        "**Telegram RPCs:**\n" + "\n".join(latency_lines("telegram_rpc_seconds", "method")),
+        "**Mongo:**\n" + "\n".join(latency_lines("mongo_command_seconds", "command")),
+        f"**Cache Hit Ratio:** {ratios}",
+        f"**RPC Queue:** {queues}",
+        f"**Event Loop Lag:** {loop_lag[0] * 1000:.1f}ms",
+    ]
+    await event.reply("\n\n".join(sections))
+
+async def on_startup():
+    await ensure_indexes()
+    await forcesub_configs.load()
+    await banned_users.load()
+    await member_index.load()
+    await invite_links.load()
+    await join_requests.load()
+    await channel_health.load()
+    asyncio.ensure_future(forcesub_configs.watch())
+    await resume_broadcasts()
+    asyncio.ensure_future(stats_buffer.run())
+    asyncio.ensure_future(member_index.run())
+    asyncio.ensure_future(join_requests.run())
+    asyncio.ensure_future(channel_health.run())
+    asyncio.ensure_future(mongo_breaker.run())
+    asyncio.ensure_future(monitor_loop_lag())
+    if update_recorder:
+        asyncio.ensure_future(update_recorder.run())
+        logger.info(f"Capturing updates to {CAPTURE_FILE}")
+    if METRICS_PORT:
+        await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Metrics served on {METRICS_HOST}:{METRICS_PORT}")
+
+async def main():
+    await bot.start(bot_token=BOT_TOKEN)
+    await resolver.get_me()
+    await on_startup()
+    logger.info("Bot started")
+    try:
+        bot.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.disconnect()))
+    except NotImplementedError:
+        pass
+    await bot.run_until_disconnected()
+    await stats_buffer.close()
+    if update_recorder:
+        update_recorder.flush()
+
+if __name__ == "__main__":
+    bot.loop.run_until_complete(main())
@@ -0,0 +1,266 @@
+# Maintenance commands for the bot's database. Every command streams: export
+# reads one cursor batch at a time, import writes one batch at a time and
+# prune pages through groups by chat id, so memory stays flat however many
+# users and groups there are.
+#
+#   python -m maintenance export backup/                    # every collection
+#   python -m maintenance export backup/ --collections users groups
+#   python -m maintenance import backup/                    # insert, skip existing _ids
+#   python -m maintenance import backup/groups.jsonl.gz --upsert --batch-size 5000
+#   python -m maintenance prune --dry-run                   # list unreachable groups
+#   python -m maintenance prune --rate 5
+#
+# Exports are gzip compressed JSON lines in MongoDB extended JSON, one file
+# per collection, so dates and ids come back with their types. Prune logs in
+# with BOT_TOKEN under its own session (SESSION_NAME, default "maintenance")
+# on a client of its own that asks Telegram not to send it updates, so the
+# running bot keeps receiving every update and none of the bot's handlers run
+# here. It only borrows the bot's RPC gateway, fanout and collections.
+import os
+import gzip
+import time
+import argparse
+import logging
+
+from bson import json_util
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from telethon.errors import (
+    ChannelPrivateError, ChannelInvalidError, ChatIdInvalidError, PeerIdInvalidError, UserNotParticipantError
+)
+from telethon import utils
+from telethon.tl.functions.channels import GetParticipantRequest
+from telethon.tl.functions.messages import GetFullChatRequest
+from telethon.tl.types import InputPeerSelf, PeerChannel, PeerChat
+
+os.environ.setdefault("SESSION_NAME", "maintenance")
+import bot as botmod
+
+logger = logging.getLogger("DURGESH")
+
+SUFFIX = ".jsonl.gz"
+PROGRESS_EVERY = 100000
+DUPLICATE_KEY = 11000
+
+# Errors meaning the bot is no longer in the group. Anything else (FloodWait
+# past its retries, timeouts) leaves the group alone.
+PRUNE_GONE_ERRORS = (
+    ChannelPrivateError, ChannelInvalidError, ChatIdInvalidError, PeerIdInvalidError, UserNotParticipantError
+)
+
+# Collections holding per-group documents with a chat_id field
+PRUNE_COLLECTIONS = ("groups", "forcesub", "group_stats", "join_requests")
+# Collections keyed "chat_id:user_id" without a chat_id field
+PRUNE_PREFIXED_COLLECTIONS = ("audit_mutes",)
+
+async def export_collection(collection, path, batch_size):
+    count = 0
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        async for doc in collection.find({}).batch_size(batch_size):
+            f.write(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS))
+            f.write("\n")
+            count += 1
+            if count % PROGRESS_EVERY == 0:
+                logger.info(f"{collection.name}: {count} exported")
+    os.replace(tmp, path)
+    return count
+
+async def export(args):
+    os.makedirs(args.directory, exist_ok=True)
+    names = args.collections or sorted(
+        name for name in await botmod.db.list_collection_names() if not name.startswith("system.")
+    )
+    for name in names:
+        start = time.perf_counter()
+        path = os.path.join(args.directory, name + SUFFIX)
+        count = await export_collection(botmod.db[name], path, args.batch_size)
+        logger.info(f"{name}: {count} documents to {path} in {time.perf_counter() - start:.1f}s")
+
+def read_batches(path, batch_size):
+    batch = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            batch.append(json_util.loads(line, json_options=json_util.RELAXED_JSON_OPTIONS))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+# Inserts a batch, skipping documents whose _id is already there. Returns
+# (written, skipped).
+async def insert_batch(collection, batch, upsert):
+    if upsert:
+        result = await collection.bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False
+        )
+        return result.upserted_count + result.modified_count, result.matched_count - result.modified_count
+    try:
+        await collection.insert_many(batch, ordered=False)
+        return len(batch), 0
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+        return e.details.get("nInserted", 0), len(errors)
+
+def import_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(SUFFIX)))
+        else:
+            files.append(path)
+    return files
+
+async def import_(args):
+    files = import_files(args.paths)
+    if not files:
+        raise SystemExit(f"No {SUFFIX} files in {' '.join(args.paths)}")
+    for path in files:
+        name = os.path.basename(path)
+        if not name.endswith(SUFFIX):
+            raise SystemExit(f"{path} is not a {SUFFIX} export")
+        collection = botmod.db[name[:-len(SUFFIX)]]
+        if args.drop:
+            await collection.drop()
+        start = time.perf_counter()
+        written = skipped = 0
+        next_report = PROGRESS_EVERY
+        for batch in read_batches(path, args.batch_size):
+            batch_written, batch_skipped = await insert_batch(collection, batch, args.upsert)
+            written += batch_written
+            skipped += batch_skipped
+            if written + skipped >= next_report:
+                logger.info(f"{collection.name}: {written + skipped} imported")
+                next_report += PROGRESS_EVERY
+        logger.info(
+            f"{collection.name}: {written} written, {skipped} unchanged or already present "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+    await botmod.ensure_indexes()
+
+# True if the bot is still in the group, False if it is gone and None if
+# the stored id cannot be turned into a peer Telegram will accept. Peers are
+# built from the stored id rather than looked up in the session's cache,
+# which starts out empty for this client.
+async def reachable(client, chat_id, bucket):
+    await bucket.acquire()
+    try:
+        real_id, peer_type = utils.resolve_id(chat_id)
+        if peer_type is PeerChannel:
+            await client(GetParticipantRequest(channel=PeerChannel(real_id), participant=InputPeerSelf()))
+        elif peer_type is PeerChat:
+            await client(GetFullChatRequest(real_id))
+        else:
+            raise ValueError(f"{chat_id} is not a group id")
+    except PRUNE_GONE_ERRORS:
+        return False
+    except ValueError as e:
+        logger.warning(f"Could not resolve {chat_id}, keeping it: {e}")
+        return None
+    return True
+
+async def remove_groups(chat_ids):
+    for name in PRUNE_COLLECTIONS:
+        await botmod.db[name].delete_many({"chat_id": {"$in": chat_ids}})
+    prefix = "^(" + "|".join(str(chat_id) for chat_id in chat_ids) + "):"
+    for name in PRUNE_PREFIXED_COLLECTIONS:
+        await botmod.db[name].delete_many({"_id": {"$regex": prefix}})
+
+# Channel health is kept per channel, not per group, so it goes once no
+# remaining config and no FSUB channel names the channel
+async def prune_channel_health(dry_run):
+    referenced = {botmod.marked_channel_id(channel_id) for channel_id in botmod.FSUB_IDS}
+    async for config in botmod.db["forcesub"].find({}, {"_id": 0, "channels": 1, "channel_id": 1}):
+        referenced.update(botmod.config_channels(config))
+    health = botmod.db["channel_health"]
+    stale = [doc["_id"] async for doc in health.find({"_id": {"$nin": list(referenced)}}, {"_id": 1})]
+    if stale and not dry_run:
+        await health.delete_many({"_id": {"$in": stale}})
+    return len(stale)
+
+async def prune(args):
+    client = botmod.ScheduledClient(
+        botmod.SESSION_NAME, botmod.API_ID, botmod.API_HASH, flood_sleep_threshold=0, receive_updates=False
+    )
+    await client.start(bot_token=botmod.BOT_TOKEN)
+    groups = botmod.db["groups"]
+    bucket = botmod.TokenBucket(args.rate)
+    checked = gone_total = failed = unresolved = 0
+    cursor = None
+    try:
+        with botmod.rpc_lane(botmod.LANE_BACKGROUND):
+            while True:
+                query = {"chat_id": {"$gt": cursor}} if cursor is not None else {}
+                page = await groups.find(query, {"_id": 0, "chat_id": 1}) \
+                    .sort("chat_id", 1).limit(args.batch_size).to_list(args.batch_size)
+                if not page:
+                    break
+                cursor = page[-1]["chat_id"]
+                chat_ids = [group["chat_id"] for group in page]
+
+                results = await botmod.fanout(lambda chat_id: reachable(client, chat_id, bucket), chat_ids,
+                                              args.concurrency)
+                gone = [chat_id for chat_id, ok in results.ok if ok is False]
+                for chat_id, error in results.failed:
+                    logger.warning(f"Could not check {chat_id}, keeping it: {error!r}")
+                checked += len(chat_ids)
+                failed += len(results.failed)
+                unresolved += sum(1 for _, ok in results.ok if ok is None)
+                gone_total += len(gone)
+
+                if gone and args.dry_run:
+                    print("\n".join(str(chat_id) for chat_id in gone))
+                elif gone:
+                    await remove_groups(gone)
+                logger.info(
+                    f"Checked {checked} groups, {gone_total} unreachable, {unresolved} unresolvable, {failed} failed"
+                )
+    finally:
+        await client.disconnect()
+    stale = await prune_channel_health(args.dry_run)
+    verb = "would be removed" if args.dry_run else "removed"
+    logger.info(
+        f"Done: {checked} groups checked, {gone_total} {verb}, {unresolved} could not be resolved, "
+        f"{failed} could not be checked; {stale} unused channel health entries {verb}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m maintenance", description="Export, import and prune the bot's data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write collections to compressed JSON lines")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--collections", nargs="+", metavar="NAME", help="default: every collection")
+    export_parser.add_argument("--batch-size", type=int, default=1000, help="documents per cursor batch")
+
+    import_parser = commands.add_parser("import", help="load exported files back into the database")
+    import_parser.add_argument("paths", nargs="+", help="export files or directories holding them")
+    import_parser.add_argument("--batch-size", type=int, default=1000, help="documents per write")
+    import_parser.add_argument("--upsert", action="store_true", help="replace documents with the same _id")
+    import_parser.add_argument("--drop", action="store_true", help="drop each collection before loading it")
+
+    prune_parser = commands.add_parser("prune", help="remove groups the bot is no longer in")
+    prune_parser.add_argument("--batch-size", type=int, default=200, help="groups checked per page")
+    prune_parser.add_argument("--rate", type=float, default=5, help="checks per second")
+    prune_parser.add_argument("--concurrency", type=int, default=10, help="checks in flight")
+    prune_parser.add_argument("--dry-run", action="store_true", help="print unreachable groups without removing them")
+
+    args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error("--batch-size must be positive")
+    if args.command == "prune" and not botmod.BOT_TOKEN:
+        parser.error("prune needs BOT_TOKEN")
+    if not botmod.MONGO_URI:
+        parser.error("MONGO_URL is not set")
+
+    run = {"export": export, "import": import_, "prune": prune}[args.command]
+    botmod.bot.loop.run_until_complete(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Replay an update capture (see CAPTURE_FILE in bot.py) against the handlers
+# in bot.py, using the fake client and in-memory database from bench.py.
+#
+#   python replay.py capture.jsonl               # original pace
+#   python replay.py capture.jsonl --speed 10    # ten times faster
+#   python replay.py capture.jsonl --speed max   # as fast as the handlers go
+#
+# Every group in the capture gets a force subscription config so enforcement
+# runs, and private chats check the bot's own FSUB channels. The report adds
+# cache hit ratios, rate limiter hits and how far a paced replay fell behind
+# the recorded timeline.
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import zlib
+from collections import Counter
+
+import bench
+from bench import (
+    CHANNEL_BASE, OWNER_ID, FakeMessage, FakeMessageEvent, FakeCallbackEvent,
+    Run, setup, prime, drain, channel_id, user_entity, print_table
+)
+
+CHANNEL_POOL = 8
+
+# Records in file order. A line cut short by a crash is skipped.
+def read_capture(path):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    records.sort(key=lambda record: record["t"])
+    return records
+
+def build_event(client, record):
+    private = bool(record.get("p"))
+    owner = bool(record.get("o"))
+    sender = user_entity(OWNER_ID if owner else record["u"]) if "u" in record else None
+    chat_id = OWNER_ID if owner and private else record["c"]
+    if record["k"] == "c":
+        return FakeCallbackEvent(client, chat_id, sender, record["d"].encode(), private)
+    text = record.get("x") or "x" * record.get("n", 0)
+    reply_to = FakeMessage(id=1, chat_id=chat_id, text="Replay") if record.get("r") else None
+    return FakeMessageEvent(client, chat_id, sender, text, private, reply_to)
+
+def group_channels(chat_id, count):
+    first = zlib.crc32(str(chat_id).encode()) % CHANNEL_POOL
+    return [(first + i) % CHANNEL_POOL + 1 for i in range(count)]
+
+async def replay(args):
+    records = read_capture(args.capture)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit(f"No updates in {args.capture}")
+
+    fsub = [channel_id(n) for n in range(1, args.private_channels + 1)]
+    botmod, client, database = await setup(args, fsub)
+    client.population = sorted({record["u"] for record in records if "u" in record and not record.get("o")})
+
+    groups = sorted({record["c"] for record in records if record["c"] < 0})
+    if args.group_channels:
+        for chat_id in groups:
+            picked = group_channels(chat_id, args.group_channels)
+            await database["forcesub"].insert_one({
+                "chat_id": chat_id, "enabled": True, "mode": "multiple" if len(picked) > 1 else "single",
+                "channels": [{"id": CHANNEL_BASE + n, "title": f"Bench Channel {n}", "username": None}
+                             for n in picked]
+            })
+    await prime(botmod, client, [channel_id(n) for n in range(1, CHANNEL_POOL + 1)], args.seed_index)
+
+    rate_limited = Counter()
+    is_rate_limited = botmod.is_rate_limited
+
+    async def counted_rate_limit(user_id, command=None):
+        limited = await is_rate_limited(user_id, command)
+        if limited:
+            rate_limited[command or "-"] += 1
+        return limited
+
+    botmod.is_rate_limited = counted_rate_limit
+
+    run = Run("replay", client, database)
+    behind = 0.0
+    if args.speed == "max":
+        await run.feed(botmod, [build_event(client, record) for record in records], args.concurrency)
+    else:
+        speed = float(args.speed)
+        tasks = []
+        run.started = start = time.perf_counter()
+        origin = records[0]["t"]
+        for record in records:
+            due = (record["t"] - origin) / speed
+            delay = due - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+            tasks.append(asyncio.ensure_future(run.handle(botmod, build_event(client, record))))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await botmod.stats_buffer.close()
+    await drain()
+    run.finish()
+
+    report = run.report()
+    report["kinds"] = dict(Counter(
+        "callback" if r["k"] == "c" else "command" if "x" in r else "message" for r in records
+    ))
+    report["captured_seconds"] = round(records[-1]["t"] - records[0]["t"], 3)
+    report["max_behind_seconds"] = round(behind, 3)
+    report["cache_hit_ratio"] = {dict(k)["cache"]: round(v, 3) for k, v in botmod.cache_ratios().items()}
+    report["rate_limited"] = dict(rate_limited)
+    report["rate_limiter_users"] = len(botmod.rate_limiter)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured updates against the bot's handlers")
+    parser.add_argument("capture", help="file written by the bot with CAPTURE_FILE set")
+    parser.add_argument("--speed", default="1", help="1 for the recorded pace, N for N times faster, max for no pacing")
+    parser.add_argument("--limit", type=int, default=0, help="only replay the first N updates")
+    parser.add_argument("--group-channels", type=int, default=2, help="required channels per captured group")
+    parser.add_argument("--private-channels", type=int, default=2, help="channels in the bot's own FSUB list")
+    bench.add_client_options(parser)
+    args = parser.parse_args()
+    if args.speed != "max":
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed must be a positive number or max")
+    args.users = 0
+
+    with tempfile.TemporaryDirectory() as session_dir:
+        args.session_dir = session_dir
+        report = asyncio.run(replay(args))
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+        return
+    print_table([report])
+    for key in ("kinds", "captured_seconds", "max_behind_seconds", "cache_hit_ratio",
+                "rate_limited", "rate_limiter_users"):
+        print(f"  {key}: {report[key]}")
+
+if __name__ == "__main__":
+    main()